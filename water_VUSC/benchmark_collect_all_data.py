@@ -0,0 +1,296 @@
+# This script benchmarks the trajectory analysis in collect_all_data_N.py
+# Usage: python benchmark_collect_all_data.py parse simu_1.xc.xyz [nframes]
+#        python benchmark_collect_all_data.py parallel simu_1.xc.xyz [nprocs ...]
+#        python benchmark_collect_all_data.py precision simu_1.xc.xyz [tolerance]
+#        python benchmark_collect_all_data.py compressed simu_1.xc.xyz [nframes]
+#        python benchmark_collect_all_data.py acf simu_1.xc.xyz [nprocs ...]
+#        python benchmark_collect_all_data.py fanout simu_1.xc.xyz [nworkers ...]
+#        python benchmark_collect_all_data.py memory simu_1.xc.xyz [block_size ...]
+# Add --dtfs=FS for a trajectory without its i-PI input.
+
+import numpy as np
+import os, sys, time
+import shutil, tempfile
+import glob
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+import collect_all_data_N
+from collect_all_data_N import MD_Analysis, XYZ_Metadata, open_xyz, iter_xyz_blocks, load_xyz_parallel, observable_groups
+from collect_all_data_N import COMPRESSED_XYZ_CODECS, FOLDER_OBSERVABLES, estimate_task_memory
+
+# The time between frames of --dtfs, None to read it from the i-PI input;
+# the copies in temporary folders are given the one of the original
+DTFS = None
+
+
+def time_step_fs(xyz_filename):
+    # The time between frames of a trajectory in its own folder, next to its
+    # i-PI input, from its first two frames only
+    with open_xyz(xyz_filename) as myfile:
+        natoms = int(myfile.readline().strip())
+        lines = [line.decode() for line in islice(myfile, natoms + 3)]
+    labels = [line.split()[0] for line in lines[1:natoms+1]]
+    return XYZ_Metadata(xyz_filename, [lines[0], lines[natoms+2]], labels).time_step_fs(DTFS)
+
+
+def load_xyz_legacy(xyz_filename, natoms, nframes):
+    # The per-line islice/split loop previously used by MD_Analysis.load_xyz
+    next_n_data = lambda file_opened, N : [x.strip().split()[1:] for x in islice(file_opened, N)]
+    traj = np.zeros((natoms, 3, nframes))
+    with open(xyz_filename, 'r') as myfile:
+        for n in range(nframes):
+            try:
+                data = next_n_data(myfile, natoms+2)[2:]
+                traj[:, :, n] = np.asarray(data).astype(float)
+            except:
+                return traj[:, :, :n]
+    return traj
+
+
+def load_xyz_bulk(xyz_filename, natoms, nframes):
+    blocks = [block for block in iter_xyz_blocks(xyz_filename, natoms, nframe_max=nframes)]
+    return np.concatenate(blocks, axis=0).transpose(1, 2, 0)
+
+
+def benchmark_parse(xyz_filename, nframes=10001):
+    a = MD_Analysis(xyz_filename, dtfs=DTFS, stream=True)
+    print("%s: %d atoms" %(xyz_filename, a.natoms))
+    results = []
+    for name, reader in [("islice/split loop", load_xyz_legacy), ("bulk parser", load_xyz_bulk)]:
+        t0 = time.time()
+        traj = reader(xyz_filename, a.natoms, nframes)
+        dt = time.time() - t0
+        print("%-20s %6d frames in %8.2f s, %10.1f frames/s" %(name, traj.shape[-1], dt, traj.shape[-1] / dt))
+        results.append(traj)
+    print("identical results: %s" %np.array_equal(results[0], results[1]))
+
+
+def benchmark_parallel(xyz_filename, *nprocs_list):
+    a = MD_Analysis(xyz_filename, dtfs=DTFS, stream=True)
+    nprocs_list = nprocs_list or (2, 4, 8)
+    t0 = time.time()
+    serial = load_xyz_bulk(xyz_filename, a.natoms, a.nframes)
+    t_serial = time.time() - t0
+    print("%-12s %6d frames in %8.2f s, %10.1f frames/s" %("1 process", a.nframes, t_serial, a.nframes / t_serial))
+    for nprocs in nprocs_list:
+        t0 = time.time()
+        traj, shm = load_xyz_parallel(xyz_filename, a.natoms, a.frame_offsets, a.nframes, nprocs)
+        dt = time.time() - t0
+        print("%-12s %6d frames in %8.2f s, %10.1f frames/s, speedup %5.2f, identical results: %s"
+              %("%d processes" %nprocs, traj.shape[-1], dt, traj.shape[-1] / dt, t_serial / dt, np.array_equal(serial, traj)))
+        del traj, shm
+
+
+def benchmark_compressed(xyz_filename, nframes=10001):
+    # Stream the plain trajectory and its gzip/bz2/xz copies (written to a
+    # temporary folder) through the block reader, decompressing with the
+    # command line tools where installed and with the python codecs
+    a = MD_Analysis(xyz_filename, dtfs=DTFS, stream=True)
+    nbytes = a.frame_offsets[min(nframes, a.nframes)]
+    outdir = tempfile.mkdtemp()
+    try:
+        t0 = time.time()
+        serial = load_xyz_bulk(xyz_filename, a.natoms, nframes)
+        dt = time.time() - t0
+        print("%-22s %6d frames in %8.2f s, %8.1f MB/s" %("plain", serial.shape[-1], dt, nbytes / dt / 1e6))
+        for suffix, (codec, command) in COMPRESSED_XYZ_CODECS.items():
+            filename = os.path.join(outdir, os.path.basename(xyz_filename) + suffix)
+            with open(xyz_filename, 'rb') as myfile, codec(filename, 'wb') as compressed:
+                shutil.copyfileobj(myfile, compressed)
+            for external in [True, False]:
+                if external and not shutil.which(command[0]):
+                    print("%-22s not installed" %command[0])
+                    continue
+                collect_all_data_N.USE_EXTERNAL_DECOMPRESSORS = external
+                t0 = time.time()
+                traj = load_xyz_bulk(filename, a.natoms, nframes)
+                dt = time.time() - t0
+                name = "%s (%s)" %(suffix, command[0] if external else "python")
+                print("%-22s %6d frames in %8.2f s, %8.1f MB/s, ratio %5.2f, identical results: %s"
+                      %(name, traj.shape[-1], dt, nbytes / dt / 1e6, os.path.getsize(xyz_filename) / float(os.path.getsize(filename)),
+                        np.array_equal(serial, traj)))
+    finally:
+        collect_all_data_N.USE_EXTERNAL_DECOMPRESSORS = True
+        shutil.rmtree(outdir)
+
+
+def benchmark_acf(xyz_filename, *nprocs_list):
+    # The per-molecule loop over auto_correlation_function_simple against the
+    # batched FFT on the O velocities of all water molecules
+    a = MD_Analysis(xyz_filename, dtfs=DTFS, nprocs=1)
+    traj = a.species_traj("time")
+    velocity = np.gradient(traj.O, a.dtfs, axis=-1, edge_order=2)
+    print("%d molecules x 3 x %d frames" %(velocity.shape[0], velocity.shape[-1]))
+    t0 = time.time()
+    loop = np.array([[a.auto_correlation_function_simple(velocity[i, j]) for j in range(3)]
+                     for i in range(velocity.shape[0])])
+    t_loop = time.time() - t0
+    print("%-16s %8.3f s" %("fftconvolve loop", t_loop))
+    for nprocs in nprocs_list or (1,):
+        a.nprocs = nprocs
+        t0 = time.time()
+        batch = a.auto_correlation_function_batch(velocity)
+        dt = time.time() - t0
+        print("%-16s %8.3f s, speedup %6.1f, max relative difference %.2e"
+              %("batch, %d worker%s" %(nprocs, "s" if nprocs > 1 else ""), dt, t_loop / dt,
+                np.max(np.abs(batch - loop)) / np.max(np.abs(loop))))
+
+
+def benchmark_fanout(xyz_filename, *nworkers_list):
+    # The outputs of one trajectory written one after the other and by
+    # nworkers processes attached to the trajectory in shared memory, each
+    # into its own temporary folder; the load is not timed
+    names = ["vac", "msd", "dac", "oac1", "oac2", "OHvac", "pair_dist", "bond_length_dist"]
+    print("groups of outputs: %s" %observable_groups(names))
+    dtfs = time_step_fs(xyz_filename)
+    outdirs = []
+    try:
+        for nworkers in (1,) + (nworkers_list or (4,)):
+            outdirs.append(tempfile.mkdtemp())
+            local_filename = os.path.join(outdirs[-1], os.path.basename(xyz_filename))
+            os.symlink(os.path.abspath(xyz_filename), local_filename)
+            a = MD_Analysis(local_filename, dtfs=dtfs, nprocs=nworkers)
+            t0 = time.time()
+            a.output_observables(names, nworkers)
+            dt = time.time() - t0
+            if nworkers == 1:
+                t_serial = dt
+            identical = all(np.array_equal(np.loadtxt(filename), np.loadtxt(os.path.join(outdirs[-1], os.path.basename(filename))))
+                            for filename in glob.glob(os.path.join(outdirs[0], "*.txt")))
+            print("%-12s %8.2f s, speedup %5.2f, identical results: %s"
+                  %("%d process%s" %(nworkers, "es" if nworkers > 1 else ""), dt, t_serial / dt, identical))
+    finally:
+        for outdir in outdirs:
+            shutil.rmtree(outdir)
+
+
+def resident_memory(key):
+    # VmRSS (current) or VmHWM (peak) resident memory of this process in bytes
+    with open("/proc/self/status") as myfile:
+        for line in myfile:
+            if line.startswith(key + ":"):
+                return int(line.split()[1]) * 1024
+
+
+def streamed_peak_memory(task):
+    # Write one output of a streamed trajectory in this process and return
+    # how far its resident memory rose above the one after the header was read
+    xyz_filename, observable, dtfs, block_size = task
+    a = MD_Analysis(xyz_filename, dtfs=dtfs, stream=True, block_size=block_size)
+    with open("/proc/self/clear_refs", "w") as myfile:
+        # Reset the peak (VmHWM) to the current resident memory
+        myfile.write("5")
+    rss = resident_memory("VmRSS")
+    if observable in FOLDER_OBSERVABLES:
+        a.accumulate_folder_observable(observable)
+    else:
+        getattr(a, a.output_methods[observable])()
+    return resident_memory("VmHWM") - rss
+
+
+def benchmark_memory(xyz_filename, *block_sizes):
+    # Compare estimate_task_memory with the peak memory of streamed outputs
+    # of the plain trajectory and of a gzip copy, each measured in a process
+    # of its own and writing into a temporary folder (Linux only)
+    names = ["pair_dist", "bond_length_dist", "dac", "rdf", "water_geometry"]
+    dtfs = time_step_fs(xyz_filename)
+    outdirs = [tempfile.mkdtemp()]
+    try:
+        filenames = [os.path.abspath(xyz_filename), os.path.join(outdirs[0], os.path.basename(xyz_filename) + ".gz")]
+        with open(xyz_filename, 'rb') as myfile, COMPRESSED_XYZ_CODECS[".gz"][0](filenames[1], 'wb') as compressed:
+            shutil.copyfileobj(myfile, compressed)
+        passed = True
+        for filename in filenames:
+            for block_size in block_sizes or (100, 1000):
+                for name in names:
+                    outdirs.append(tempfile.mkdtemp())
+                    local_filename = os.path.join(outdirs[-1], os.path.basename(filename))
+                    os.symlink(filename, local_filename)
+                    estimate = estimate_task_memory(local_filename, [name], stream=True, block_size=block_size, dtfs=dtfs)
+                    # The worker prints the progress of the output
+                    sys.stdout.flush()
+                    with ProcessPoolExecutor(1) as executor:
+                        peak = executor.submit(streamed_peak_memory, (local_filename, name, dtfs, block_size)).result()
+                    ok = estimate >= peak
+                    passed = passed and ok
+                    print("%-4s %-16s block %5d: measured %8.1f MB, estimate %8.1f MB  %s"
+                          %("gz" if filename.endswith(".gz") else "xyz", name, block_size, peak / 1e6, estimate / 1e6,
+                            "PASS" if ok else "FAIL"))
+    finally:
+        for outdir in outdirs:
+            shutil.rmtree(outdir)
+    print("estimate above the measured peak: %s" %("PASS" if passed else "FAIL"))
+    return passed
+
+
+def run_outputs(xyz_filename, outdir, dtype):
+    # Write the outputs of one trajectory into outdir without touching the
+    # files (and caches) next to the original trajectory
+    dtfs = time_step_fs(xyz_filename)
+    local_filename = os.path.join(outdir, os.path.basename(xyz_filename))
+    os.symlink(os.path.abspath(xyz_filename), local_filename)
+    a = MD_Analysis(local_filename, dtfs=dtfs, stream=True, dtype=dtype)
+    a.output_dipole_autocorrelation()
+    a = MD_Analysis(local_filename, dtfs=dtfs, dtype=dtype)
+    a.output_velocity_autocorrelation()
+    a.output_OHvelocity_autocorrelation()
+    a.output_orientation_autocorrelation()
+    return local_filename
+
+
+def benchmark_precision(xyz_filename, tolerance=1e-3):
+    # Compare the float32 outputs with the float64 ones. The error of each
+    # column is measured relative to the largest value of the float64 column.
+    outdirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+    try:
+        filenames = []
+        for outdir, dtype in zip(outdirs, [np.float64, np.float32]):
+            t0 = time.time()
+            filenames.append(run_outputs(xyz_filename, outdir, dtype))
+            print("%-8s outputs in %8.2f s" %(np.dtype(dtype).name, time.time() - t0))
+        passed = True
+        for suffix in ["dac", "vac", "OHvac", "oac1"]:
+            ref = np.loadtxt("%s.%s.txt" %(filenames[0], suffix))
+            data = np.loadtxt("%s.%s.txt" %(filenames[1], suffix))
+            scale = np.max(np.abs(ref), axis=0)
+            scale[scale == 0.0] = 1.0
+            err = np.max(np.abs(data - ref), axis=0) / scale
+            ok = ref.shape == data.shape and np.all(err <= tolerance)
+            passed = passed and ok
+            print("%-6s max relative error %10.3e (worst column %d)  %s"
+                  %(suffix, np.max(err), np.argmax(err), "PASS" if ok else "FAIL"))
+    finally:
+        for outdir in outdirs:
+            shutil.rmtree(outdir)
+    print("float32 within tolerance %.1e: %s" %(tolerance, "PASS" if passed else "FAIL"))
+    return passed
+
+
+if __name__ == "__main__":
+    argv = [arg for arg in sys.argv if not arg.startswith("--dtfs=")]
+    for arg in sys.argv:
+        if arg.startswith("--dtfs="):
+            DTFS = float(arg.split("=", 1)[1])
+    if len(argv) < 3:
+        print("Usage: python benchmark_collect_all_data.py parse|parallel|precision|compressed|acf|fanout|memory simu_1.xc.xyz [args] [--dtfs=FS]")
+        sys.exit(1)
+    task, args = argv[1], argv[2:]
+    if task == "parse":
+        benchmark_parse(args[0], *[int(x) for x in args[1:]])
+    elif task == "parallel":
+        benchmark_parallel(args[0], *[int(x) for x in args[1:]])
+    elif task == "compressed":
+        benchmark_compressed(args[0], *[int(x) for x in args[1:]])
+    elif task == "acf":
+        benchmark_acf(args[0], *[int(x) for x in args[1:]])
+    elif task == "fanout":
+        benchmark_fanout(args[0], *[int(x) for x in args[1:]])
+    elif task == "memory":
+        if not benchmark_memory(args[0], *[int(x) for x in args[1:]]):
+            sys.exit(1)
+    elif task == "precision":
+        if not benchmark_precision(args[0], *[float(x) for x in args[1:]]):
+            sys.exit(1)
+    else:
+        print("Unknown benchmark %s" %task)
+        sys.exit(1)
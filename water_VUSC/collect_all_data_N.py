@@ -5,10 +5,26 @@ import matplotlib.pyplot as plt
 from scipy import signal
 import os, sys, time
 import math
-from itertools import islice
+from itertools import islice, groupby
 from scipy import fftpack
+import scipy.fft
 import glob
 import json
+import multiprocessing
+from multiprocessing import shared_memory
+import gzip, bz2, lzma
+import shutil, subprocess
+from contextlib import contextmanager
+import re
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from scipy.spatial import cKDTree
+import traceback
+import inspect
+import hashlib, fcntl
+import socket, threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 
 def smooth(x,window_len=11,window='hamming'):
     """smooth the data using a window with requested size.
@@ -55,74 +71,1389 @@ def smooth(x,window_len=11,window='hamming'):
     return y[window_len//2-1:-window_len//2]
 
 
+# Compressed trajectories are decoded on the fly, by a multi-threaded command
+# line decompressor if one is installed or by the python codec otherwise
+COMPRESSED_XYZ_CODECS = {".gz": (gzip.open, ["pigz", "-dc"]),
+                         ".bz2": (bz2.open, ["lbzip2", "-dc"]),
+                         ".xz": (lzma.open, ["xz", "-T0", "-dc"])}
+USE_EXTERNAL_DECOMPRESSORS = True
+# The binary trajectory cache (see open_traj_cache) is not written next to
+# compressed trajectories, which are compressed to save space; set this to
+# keep one for them as well
+CACHE_COMPRESSED_TRAJECTORIES = False
+
+def is_compressed(xyz_filename):
+    return os.path.splitext(xyz_filename)[1] in COMPRESSED_XYZ_CODECS
+
+
+def run_filename(xyz_filename):
+    # The trajectory without the suffix of its compression, e.g., simu_1.xc.xyz
+    # for simu_1.xc.xyz.gz, which names the outputs and sidecar files of the
+    # run, so that they do not change when a finished run is compressed
+    return os.path.splitext(xyz_filename)[0] if is_compressed(xyz_filename) else xyz_filename
+
+
+def source_identity(xyz_filename):
+    # The file a sidecar (frame index, trajectory cache) is built from
+    stat = os.stat(xyz_filename)
+    return {"source": os.path.basename(xyz_filename), "source_size": stat.st_size, "source_mtime_ns": stat.st_mtime_ns}
+
+
+def same_source(info, xyz_filename):
+    # Whether a sidecar built from info (see source_identity) holds for this
+    # file: the same file unchanged, or another copy of the run with the same
+    # mtime, as gzip, bzip2 (to the second) and xz keep it when compressing
+    current = source_identity(xyz_filename)
+    if info.get("source", current["source"]) == current["source"]:
+        return info["source_size"] == current["source_size"] and info["source_mtime_ns"] == current["source_mtime_ns"]
+    return info["source_mtime_ns"] // 10**9 == current["source_mtime_ns"] // 10**9
+
+
+@contextmanager
+def open_xyz(xyz_filename):
+    # Open a plain or compressed xyz file as a binary stream. Only plain files
+    # can seek.
+    if not is_compressed(xyz_filename):
+        with open(xyz_filename, 'rb') as myfile:
+            yield myfile
+        return
+    codec, command = COMPRESSED_XYZ_CODECS[os.path.splitext(xyz_filename)[1]]
+    if USE_EXTERNAL_DECOMPRESSORS and shutil.which(command[0]):
+        proc = subprocess.Popen(command + [xyz_filename], stdout=subprocess.PIPE, bufsize=1<<20)
+        try:
+            yield proc.stdout
+        finally:
+            # The reader may stop before the end of the trajectory
+            proc.stdout.close()
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+    else:
+        with codec(xyz_filename, 'rb') as myfile:
+            yield myfile
+
+
+def read_chunk(myfile, read_size):
+    # Read up to read_size bytes piece by piece, so that a truncated
+    # compressed file ends like a truncated plain file instead of losing the
+    # data decoded before the truncation
+    data, size = [], 0
+    try:
+        while size < read_size:
+            part = myfile.read1(read_size - size)
+            if not part:
+                break
+            data.append(part)
+            size += len(part)
+    except EOFError:
+        pass
+    return b"".join(data)
+
+
+def parse_xyz_frames(lines, natoms, dtype=np.float64, atoms=None):
+    """Convert the lines of whole xyz frames to a (nframes, natoms, 3) array.
+
+    The atom count and comment lines are dropped by their fixed stride of
+    natoms+2 lines and all coordinate columns are converted by one
+    np.loadtxt call to the requested dtype. If atoms (a slice or an index
+    array) is given, only the lines of these atoms are converted; the other
+    lines are never split, so a broken line of an atom which is not
+    selected goes unnoticed. If a frame is broken, only the frames before
+    it are returned.
+    """
+    stride = natoms + 2
+    nframes = len(lines) // stride
+    nselected = np.arange(natoms)[atoms].size if atoms is not None else natoms
+    if nframes == 0:
+        return np.zeros((0, nselected, 3), dtype=dtype)
+    frames = np.array(lines[:nframes*stride], dtype=object).reshape(nframes, stride)
+    coord_lines = frames[:, 2:] if atoms is None else frames[:, 2:][:, atoms]
+    try:
+        for n in range(nframes):
+            if int(frames[n, 0]) != natoms:
+                raise ValueError("frame %d does not have %d atoms" %(n, natoms))
+        coords = np.loadtxt(coord_lines.ravel().tolist(), usecols=(1, 2, 3), ndmin=2, dtype=dtype)
+        return coords.reshape(nframes, nselected, 3)
+    except ValueError:
+        # Keep the frames before the first broken one
+        coords = []
+        for n in range(nframes):
+            try:
+                if int(frames[n, 0]) != natoms:
+                    break
+                coords.append(np.loadtxt(coord_lines[n].tolist(), usecols=(1, 2, 3), ndmin=2, dtype=dtype))
+            except ValueError:
+                break
+        return np.array(coords, dtype=dtype).reshape(len(coords), nselected, 3)
+
+
+def read_xyz_frames(myfile, natoms, offsets, start, stop, dtype=np.float64, atoms=None, step=1):
+    # Read frames start:stop:step from an opened binary xyz file by seeking to
+    # their byte offsets; with a stride only the selected frames are read
+    if step == 1:
+        myfile.seek(offsets[start])
+        data = myfile.read(offsets[stop] - offsets[start])
+    else:
+        data = []
+        for n in range(start, stop, step):
+            myfile.seek(offsets[n])
+            data.append(myfile.read(offsets[n+1] - offsets[n]))
+        data = b"".join(data)
+    return parse_xyz_frames(data.split(b"\n"), natoms, dtype, atoms)
+
+
+def iter_xyz_blocks(xyz_filename, natoms, block_size=1000, nframe_max=None, read_size=1<<24, offsets=None,
+                    dtype=np.float64, atoms=None, start=0, step=1):
+    """Read a xyz trajectory frame block by frame block.
+
+    Each block is an array with shape (block, natoms, 3) holding at most
+    block_size frames, so the memory used by the reader does not depend on
+    the length of the trajectory. The file is read in large byte chunks of
+    read_size bytes (or, if the frame byte offsets are given, exactly one
+    block at a time) which are split into lines and parsed in bulk by
+    parse_xyz_frames. Reading stops at nframe_max frames or at the first
+    incomplete frame.
+
+    Only the frames start:nframe_max:step and the atoms selected by atoms
+    (see parse_xyz_frames) are decoded. With the frame offsets, the frames
+    which are skipped are not even read from disk; without them, their
+    lines are dropped as the chunks are split, so only the lines of the
+    selected frames are buffered. Compressed trajectories (see open_xyz)
+    cannot seek and are always read without the offsets.
+    """
+    stride = natoms + 2
+    if offsets is not None:
+        nframes = len(offsets) - 1 if nframe_max is None else min(len(offsets) - 1, nframe_max)
+        with open(xyz_filename, 'rb') as myfile:
+            for n in range(start, nframes, block_size*step):
+                stop = min(n + block_size*step, nframes)
+                nblock = len(range(n, stop, step))
+                block = read_xyz_frames(myfile, natoms, offsets, n, stop, dtype, atoms, step)
+                if block.shape[0] > 0:
+                    yield block
+                if block.shape[0] < nblock:
+                    print("Read No.%d frame but has error" %(n + block.shape[0]*step))
+                    return
+        return
+    # Only the lines of the selected frames are kept as the chunks arrive, so
+    # that the lines of at most block_size frames are held besides a chunk
+    limit = nframe_max if nframe_max is not None else np.inf
+    # nlines counts all the lines read so far, nblank the blank ones at
+    # their end and nparsed the selected frames parsed so far
+    nlines, nblank, nparsed = 0, 0, 0
+    lines, tail, eof = [], b"", False
+    with open_xyz(xyz_filename) as myfile:
+        while True:
+            while len(lines) < block_size*stride and not eof and nlines < limit*stride:
+                data = read_chunk(myfile, read_size)
+                if data:
+                    data = (tail + data).split(b"\n")
+                    tail = data.pop()
+                else:
+                    eof = True
+                    data = [tail] if tail.strip() else []
+                # The selected frames among frames nlines // stride.. of this chunk
+                first = nlines // stride
+                first = start if first <= start else start + -((start - first) // step) * step
+                for n in range(first, min((nlines + len(data) - 1) // stride + 1, limit), step):
+                    lines.extend(data[max(n*stride - nlines, 0):(n+1)*stride - nlines])
+                blank = 0
+                while blank < len(data) and not data[-1-blank].strip():
+                    blank += 1
+                nblank = nblank + blank if blank == len(data) else blank
+                nlines += len(data)
+            if eof or nlines >= limit*stride:
+                # The frames after the last complete one (blank lines at the
+                # end of the file are no frame) are not read
+                ncomplete = min((nlines - nblank) // stride if eof else limit, limit)
+                nblock = min(block_size, len(range(start, ncomplete, step)) - nparsed)
+            else:
+                ncomplete, nblock = None, block_size
+            block = parse_xyz_frames(lines[:nblock*stride], natoms, dtype, atoms)
+            del lines[:nblock*stride]
+            if block.shape[0] > 0:
+                yield block
+            if block.shape[0] < nblock:
+                print("Read No.%d frame but has error" %(start + (nparsed + block.shape[0])*step))
+                return
+            nparsed += nblock
+            if ncomplete is not None and nparsed >= len(range(start, ncomplete, step)):
+                if (nlines - nblank) % stride and ncomplete < limit:
+                    print("Read No.%d frame but has error" %ncomplete)
+                return
+
+
+def replace_atomically(filename, write):
+    # Write through a temporary file in the same folder which is then renamed,
+    # so that concurrent readers only ever see a complete file
+    tmp_filename = "%s.tmp.%d" %(filename, os.getpid())
+    try:
+        with open(tmp_filename, 'wb') as myfile:
+            write(myfile)
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def shared_array(shape, dtype):
+    # A new array in a named shared memory block, returned with the block
+    shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf), shm
+
+
+def attach_shared_array(name, shape, dtype):
+    # The array made by shared_array in another process, without a copy
+    shm = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf), shm
+
+
+def parse_xyz_range(task):
+    # Worker of load_xyz_parallel: parse frames start..stop-1 straight into the
+    # shared trajectory and return the end of the good frames
+    xyz_filename, natoms, offsets, start, stop, block_size, shm_name, shape, dtype = task
+    traj, shm = attach_shared_array(shm_name, shape, dtype)
+    n = start
+    with open(xyz_filename, 'rb') as myfile:
+        while n < stop:
+            nblock = min(block_size, stop - n)
+            block = read_xyz_frames(myfile, natoms, offsets, n, n + nblock, dtype)
+            traj[:, :, n:n+block.shape[0]] = block.transpose(1, 2, 0)
+            n += block.shape[0]
+            if block.shape[0] < nblock:
+                break
+    del traj
+    shm.close()
+    return n
+
+
+def load_xyz_parallel(xyz_filename, natoms, offsets, nframes, nprocs, block_size=1000, dtype=np.float64):
+    """Parse the first nframes frames of a xyz trajectory with nprocs processes.
+
+    The frame byte offsets split the file into frame ranges, a few per
+    process to balance the load, and each worker parses its ranges into one
+    shared memory buffer of shape (natoms, 3, nframes). The result is
+    identical to reading the file serially, including the truncation at a
+    broken frame. Returns the trajectory and the SharedMemory block backing
+    it, which must be kept alive for as long as the trajectory is used.
+    """
+    shape = (natoms, 3, nframes)
+    traj, shm = shared_array(shape, dtype)
+    try:
+        bounds = np.linspace(0, nframes, 4*nprocs + 1).astype(int)
+        tasks = [(xyz_filename, natoms, offsets, start, stop, block_size, shm.name, shape, dtype)
+                 for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+        with multiprocessing.Pool(nprocs) as pool:
+            ends = pool.map(parse_xyz_range, tasks)
+    finally:
+        # The memory stays mapped in this process after the name is removed
+        shm.unlink()
+    for task, end in zip(tasks, ends):
+        if end < task[4]:
+            print("Read No.%d frame but has error" %end)
+            traj = traj[:, :, :end]
+            break
+    return traj, shm
+
+
+XYZ_INDEX_VERSION = 1
+
+def scan_xyz_offsets(xyz_filename, natoms, start=0, read_size=1<<24):
+    """Find the byte offsets of all complete frames of a xyz trajectory.
+
+    The file is scanned once from byte start, which must be the beginning
+    of a frame, by counting newlines in large chunks. The returned array
+    has nframes+1 entries: the offset of every complete frame followed by
+    the end of the last complete frame. A partially written last frame, or
+    a frame whose atom count line is wrong, ends the trajectory. For a
+    compressed trajectory the offsets are those of the decompressed stream
+    and only give the number of frames; its atom count lines are checked
+    when the frames are parsed.
+    """
+    stride = natoms + 2
+    offsets = [np.array([start], dtype=np.int64)]
+    nlines, pos = 0, start
+    with open_xyz(xyz_filename) as myfile:
+        if start > 0:
+            myfile.seek(start)
+        while True:
+            data = read_chunk(myfile, read_size)
+            if not data:
+                break
+            newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10)
+            # A frame ends with its (stride)-th newline
+            first = (stride - 1 - nlines) % stride
+            offsets.append(newlines[first::stride].astype(np.int64) + pos + 1)
+            nlines += newlines.size
+            pos += len(data)
+        offsets = np.concatenate(offsets)
+        if is_compressed(xyz_filename):
+            return offsets
+        header = b"%d" %natoms
+        for n in range(offsets.size - 1):
+            myfile.seek(offsets[n])
+            if myfile.readline().strip() != header:
+                print("Frame %d of %s is broken, truncating" %(n, xyz_filename))
+                return offsets[:n+1]
+    return offsets
+
+
+def load_xyz_index(xyz_filename, natoms, scan=True):
+    """Return the frame byte offsets of a xyz trajectory (see scan_xyz_offsets).
+
+    The offsets are kept in the sidecar file run_filename(xyz_filename) +
+    ".idx" so that the trajectory is only scanned once, also by its
+    compressed copy (see same_source). The sidecar is rebuilt if it does not
+    match the trajectory and extended if the trajectory has grown since,
+    e.g., for a simulation which is still running. With scan False, None is
+    returned instead of scanning the file.
+    """
+    index_filename = run_filename(xyz_filename) + ".idx"
+    source = source_identity(xyz_filename)
+    offsets, info = None, None
+    try:
+        with np.load(index_filename) as index:
+            if int(index["version"]) == XYZ_INDEX_VERSION and int(index["natoms"]) == natoms:
+                offsets = index["offsets"]
+                info = {"source_size": int(index["source_size"]), "source_mtime_ns": int(index["source_mtime_ns"])}
+                if "source" in index:
+                    info["source"] = str(index["source"])
+    except (IOError, OSError, KeyError, ValueError):
+        pass
+    if offsets is not None and same_source(info, xyz_filename):
+        return offsets
+    if not scan:
+        return None
+    if (offsets is not None and info.get("source", source["source"]) == source["source"]
+            and info["source_size"] < source["source_size"] and not is_compressed(xyz_filename)):
+        print("Extending frame index %s" %index_filename)
+        offsets = np.concatenate([offsets[:-1], scan_xyz_offsets(xyz_filename, natoms, start=offsets[-1])])
+    else:
+        print("Building frame index %s" %index_filename)
+        offsets = scan_xyz_offsets(xyz_filename, natoms)
+    try:
+        replace_atomically(index_filename, lambda myfile: np.savez(myfile, version=XYZ_INDEX_VERSION, natoms=natoms,
+                           offsets=offsets, **source))
+    except (IOError, OSError):
+        print("Cannot write frame index %s" %index_filename)
+    return offsets
+
+
+TRAJ_CACHE_VERSION = 1
+
+def traj_cache_prefix(xyz_filename, dtype=np.float64):
+    # Each dtype has its own cache, e.g., simu_1.xc.xyz.traj.float32.npy
+    if np.dtype(dtype) == np.float64:
+        return "%s.traj" %run_filename(xyz_filename)
+    return "%s.traj.%s" %(run_filename(xyz_filename), np.dtype(dtype).name)
+
+
+def open_traj_cache(xyz_filename, natoms, labels, nframes, dtype=np.float64):
+    """Open the binary cache of the first nframes frames of a xyz trajectory.
+
+    The cache consists of simu_1.xc.xyz.traj.npy, holding the trajectory
+    with shape (natoms, 3, nframes), and simu_1.xc.xyz.traj.json, holding
+    the cache version, natoms, labels, frame count, dtype and the xyz file
+    it was built from (see source_identity; traj_cache_prefix names the
+    cache of a compressed run and of other dtypes than float64). The
+    trajectory is returned as a read-only memory map, or None if the cache
+    is missing or does not match the xyz file any more.
+    """
+    prefix = traj_cache_prefix(xyz_filename, dtype)
+    try:
+        with open(prefix + ".json", 'r') as myfile:
+            info = json.load(myfile)
+        if (info["version"] != TRAJ_CACHE_VERSION or info["natoms"] != natoms or info["labels"] != labels
+                or not same_source(info, xyz_filename)
+                or info["nframes_requested"] < nframes or np.dtype(info["dtype"]) != np.dtype(dtype)):
+            return None
+        traj = np.load(prefix + ".npy", mmap_mode='r')
+        if traj.shape != (natoms, 3, info["nframes"]) or traj.dtype != np.dtype(info["dtype"]):
+            return None
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+    return traj[:, :, :nframes]
+
+
+def save_traj_cache(xyz_filename, traj, labels, nframes_requested, source):
+    # Write the cache read by open_traj_cache. Both files are replaced
+    # atomically and the data goes first, so a concurrent reader never sees
+    # metadata describing a half-written array. source is the
+    # source_identity of the xyz file taken before it was parsed.
+    info = dict(source, version=TRAJ_CACHE_VERSION, natoms=traj.shape[0], labels=labels,
+                nframes=traj.shape[-1], nframes_requested=nframes_requested, dtype=traj.dtype.str)
+    prefix = traj_cache_prefix(xyz_filename, traj.dtype)
+    try:
+        replace_atomically(prefix + ".npy", lambda myfile: np.save(myfile, traj))
+        replace_atomically(prefix + ".json", lambda myfile: myfile.write(json.dumps(info).encode()))
+    except (IOError, OSError):
+        print("Cannot write trajectory cache for %s" %xyz_filename)
+
+
+def xyz_file_size(xyz_filename, scan=True):
+    # The size of the (decompressed) trajectory; for a compressed file this
+    # is the size of its complete frames, found with the frame index, and
+    # None if scan is False and the index is not built yet, as building it
+    # decodes the whole file
+    if not is_compressed(xyz_filename):
+        return os.path.getsize(xyz_filename)
+    with open_xyz(xyz_filename) as myfile:
+        natoms = int(myfile.readline().strip())
+    offsets = load_xyz_index(xyz_filename, natoms, scan)
+    return None if offsets is None else int(offsets[-1])
+
+
+class ResultManifest:
+    """The outputs of a trajectory and what they were computed from.
+
+    The manifest run_filename(xyz_filename) + ".results.json" holds, for
+    every output file, a key hashing everything its content depends on: the
+    trajectory (the size of its complete frames once decompressed and its
+    modification time, to the second, which compressing keeps), the analysis
+    settings, the observable, its parameters and the version of its code
+    (MD_Analysis.output_versions). An output is only computed again if the
+    file or its key is missing, or the key differs, e.g., after bin_num of
+    one observable changed or the code of its numbers was updated. Updates
+    are made under a lock, so several processes may write outputs of the
+    same trajectory.
+    """
+    def __init__(self, xyz_filename, size, settings, versions):
+        self.filename = run_filename(xyz_filename) + ".results.json"
+        self.source = {"size": int(size), "mtime": os.stat(xyz_filename).st_mtime_ns // 10**9}
+        self.settings = settings
+        self.versions = versions
+
+    def key(self, observable, **params):
+        content = {"source": self.source, "settings": self.settings, "observable": observable,
+                   "params": params, "version": self.versions.get(observable, 1)}
+        content = json.dumps(content, sort_keys=True, default=lambda x: np.asarray(x).tolist())
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def entries(self):
+        try:
+            with open(self.filename) as myfile:
+                return json.load(myfile)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def is_current(self, local_filename, key):
+        return self.entries().get(os.path.basename(local_filename)) == key and os.path.isfile(local_filename)
+
+    def record(self, local_filename, key):
+        # The lock file is removed by its holder, so a process which locked
+        # it in the meantime retries with the one created after
+        lock_filename = self.filename + ".lock"
+        while True:
+            lock = open(lock_filename, 'a')
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.stat(lock_filename).st_ino == os.fstat(lock.fileno()).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            lock.close()
+        try:
+            entries = self.entries()
+            entries[os.path.basename(local_filename)] = key
+            replace_atomically(self.filename, lambda myfile: myfile.write(json.dumps(entries, indent=1, sort_keys=True).encode()))
+        finally:
+            os.remove(lock_filename)
+            lock.close()
+
+
+class WorkClaims:
+    """Trajectories claimed by this job among jobs sharing the same folders.
+
+    A job claims a trajectory by creating run_filename(xyz_filename) +
+    ".claim" with O_EXCL, which only one job can do, also on a shared file
+    system, and removes it when done; a trajectory claimed by another job is
+    left to it. While the job runs (in a with block), a heartbeat thread
+    touches its claims every expiry/4 seconds, so a claim untouched for
+    expiry seconds is from a job which died and is taken over. The clocks of
+    the nodes must agree to well within expiry.
+    """
+    def __init__(self, expiry=600.0, owner=None):
+        self.expiry = expiry
+        self.owner = owner if owner is not None else "%s:%d" %(socket.gethostname(), os.getpid())
+        self.held = set()
+        self.held_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def holder(self, lock_filename):
+        # The owner written in a claim file, None if it is gone
+        try:
+            with open(lock_filename) as myfile:
+                return json.load(myfile).get("owner", "?")
+        except (IOError, OSError):
+            return None
+        except ValueError:
+            # Still being written
+            return "?"
+
+    def claim(self, xyz_filename):
+        """Claim a trajectory; returns None if claimed, or else the holder."""
+        lock_filename = run_filename(xyz_filename) + ".claim"
+        while True:
+            try:
+                fd = os.open(lock_filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                holder = self.holder(lock_filename)
+                try:
+                    age = time.time() - os.stat(lock_filename).st_mtime
+                except FileNotFoundError:
+                    continue
+                if age < self.expiry:
+                    return holder
+                # Move the stale claim away, which only one job succeeds in
+                # doing, and check that it had not been taken over meanwhile
+                stale_filename = "%s.stale.%s" %(lock_filename, self.owner.replace(":", "."))
+                try:
+                    os.rename(lock_filename, stale_filename)
+                except FileNotFoundError:
+                    continue
+                if time.time() - os.stat(stale_filename).st_mtime < self.expiry:
+                    try:
+                        os.link(stale_filename, lock_filename)
+                    except FileExistsError:
+                        pass
+                    os.remove(stale_filename)
+                    return self.holder(lock_filename)
+                os.remove(stale_filename)
+                print("Taking over the claim of %s by %s, untouched for %.0f s" %(xyz_filename, holder, age))
+                continue
+            with os.fdopen(fd, 'w') as myfile:
+                myfile.write(json.dumps({"owner": self.owner, "time": time.time()}))
+            with self.held_lock:
+                self.held.add(xyz_filename)
+            return None
+
+    def release(self, xyz_filename):
+        with self.held_lock:
+            self.held.discard(xyz_filename)
+        lock_filename = run_filename(xyz_filename) + ".claim"
+        if self.holder(lock_filename) == self.owner:
+            os.remove(lock_filename)
+
+    def heartbeat(self):
+        while not self.stopped.wait(self.expiry / 4.0):
+            with self.held_lock:
+                held = list(self.held)
+            for xyz_filename in held:
+                lock_filename = run_filename(xyz_filename) + ".claim"
+                if self.holder(lock_filename) != self.owner:
+                    print("Lost the claim of %s, which another job may now be analyzing too" %xyz_filename)
+                    continue
+                try:
+                    os.utime(lock_filename)
+                except (IOError, OSError):
+                    pass
+
+    def __enter__(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.heartbeat, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        for xyz_filename in list(self.held):
+            self.release(xyz_filename)
+
+
+def index_selection(index):
+    # The atoms of an index array as a slice if they are evenly spaced, so
+    # that the readers and numpy can use views, or else the index array
+    index = np.asarray(index, dtype=int)
+    if index.size == 1:
+        return slice(int(index[0]), int(index[0]) + 1)
+    if index.size > 1:
+        steps = np.diff(index)
+        if steps[0] > 0 and np.all(steps == steps[0]):
+            return slice(int(index[0]), int(index[-1]) + 1, int(steps[0]))
+    return index
+
+
+class Topology:
+    """The water molecules and cavity photons of a trajectory.
+
+    It is built from the atom labels. Every O starts a water molecule
+    together with the two H following it, and the L pseudo-atoms are the
+    photons, wherever they are in the file. Each cavity mode has two
+    photons, polarized along x and y: photon 2k (x) and 2k+1 (y) of mode k,
+    whose field coordinate is its x or y coordinate. All indices are file
+    indices; waters is (nwaters, 3), the O, H1 and H2 of each molecule.
+    Labels which do not fit raise a ValueError.
+    """
+    def __init__(self, labels):
+        labels = np.asarray(labels)
+        O = np.flatnonzero(labels == "O")
+        self.waters = O[:, np.newaxis] + np.arange(3)
+        self.photons = np.flatnonzero(labels == "L")
+        self.nwaters, self.nphotons = len(O), len(self.photons)
+        self.nmodes = self.nphotons // 2
+        if self.nwaters > 0 and (self.waters[-1, 2] >= len(labels) or np.any(labels[self.waters[:, 1:]] != "H")):
+            raise ValueError("not every O is followed by the two H of its water molecule")
+        if 3*self.nwaters + self.nphotons != len(labels):
+            raise ValueError("%d atoms are neither in a water molecule (O, H, H) nor photons (L)"
+                             %(len(labels) - 3*self.nwaters - self.nphotons))
+        if self.nphotons % 2 != 0:
+            raise ValueError("%d photons do not make pairs of x and y polarized modes" %self.nphotons)
+        self.polarization = np.arange(self.nphotons) % 2
+        # The atoms stored by species: all O, all H1, all H2 and the photons
+        self.order = np.concatenate([self.waters.T.ravel(), self.photons])
+        self.water_atoms = index_selection(self.waters.ravel())
+        self.O_atoms = index_selection(self.waters[:, 0])
+        self.photon_atoms = index_selection(self.photons)
+
+    def molecule_atoms(self, i):
+        return index_selection(self.waters[i])
+
+
+class Trajectory:
+    """A trajectory of water molecules and photons stored by species.
+
+    The atoms of traj, a (natoms, 3, nframes) array in file order, are
+    reordered by the topology as all O, all H1, all H2 and then the photons,
+    so that O, H1, H2 and photons are contiguous blocks and zero-copy views
+    of data. With layout "time", data has shape (natoms, 3, nframes) and the
+    time series of every coordinate is contiguous, as the correlation
+    functions need. With layout "frame", data has shape (nframes, natoms, 3)
+    and every frame is contiguous, as distances and periodic images need.
+    The atoms are stored in data if given, e.g., an array in shared memory;
+    with traj None, data already holds them.
+    """
+    def __init__(self, traj, topology, layout="time", block_size=1000, data=None):
+        natoms = topology.order.size
+        nwaters = topology.nwaters
+        self.nwaters = nwaters
+        self.layout = layout
+        # order[k] is the file index of the k-th atom of data and position the inverse
+        self.order = topology.order
+        self.position = np.argsort(self.order)
+        if traj is None:
+            self.data = data
+        elif layout == "time":
+            nframes = traj.shape[-1]
+            self.data = np.empty((natoms, 3, nframes), dtype=traj.dtype) if data is None else data
+            for k in range(3):
+                self.data[k*nwaters:(k+1)*nwaters] = traj[index_selection(topology.waters[:, k])]
+            self.data[3*nwaters:] = traj[topology.photon_atoms]
+        elif layout == "frame":
+            nframes = traj.shape[-1]
+            self.data = np.empty((nframes, natoms, 3), dtype=traj.dtype) if data is None else data
+            for n in range(0, nframes, block_size):
+                self.data[n:n+block_size] = traj[self.order, :, n:n+block_size].transpose(2, 0, 1)
+        else:
+            raise ValueError("Unknown trajectory layout %s" %layout)
+        self.O = self.species(0, nwaters)
+        self.H1 = self.species(nwaters, 2*nwaters)
+        self.H2 = self.species(2*nwaters, 3*nwaters)
+        self.photons = self.species(3*nwaters, natoms)
+        self.nbytes = self.data.nbytes
+
+    def species(self, start, stop):
+        return self.data[start:stop] if self.layout == "time" else self.data[:, start:stop]
+
+    def select(self, atoms=None):
+        # The atoms given by file indices (a slice or an index array); a view
+        # if they are consecutive here, e.g., all the O of the file
+        index = self.position if atoms is None else self.position[atoms]
+        if index.size > 0 and np.all(np.diff(index) == 1):
+            return self.species(index[0], index[-1] + 1)
+        return self.data[index] if self.layout == "time" else self.data[:, index]
+
+    def blocks(self, atoms=None, start=0, stop=None, step=1, block_size=1000):
+        # Frames start:stop:step of the atoms given by file indices, in that
+        # order, as (block, natoms, 3) arrays of layout "frame"; views if the
+        # atoms are consecutive here, else gathered one block at a time
+        index = self.position if atoms is None else self.position[atoms]
+        consecutive = index.size > 0 and np.all(np.diff(index) == 1)
+        frames = self.species(index[0], index[-1] + 1) if consecutive else self.data
+        stop = frames.shape[0] if stop is None else min(stop, frames.shape[0])
+        for n in range(start, stop, block_size*step):
+            block = frames[n:min(n+block_size*step, stop):step]
+            yield block if consecutive else block[:, index]
+
+
+def pair_distance_counts(A, B, r_edges, box):
+    """Histogram of the minimum image distances between the atoms A and B.
+
+    A and B are (nframes, natoms, 3) arrays in an orthorhombic box (a length
+    or 3 lengths). The pairs of each frame are counted with periodic
+    KD-trees, which only visit the pairs closer than r_edges[-1], into the
+    bins (r_edges[i], r_edges[i+1]], summed over all the frames. If B is A,
+    every pair is counted in both orders, but an atom is never paired with
+    itself for r_edges[0] >= 0.
+    """
+    box = np.broadcast_to(np.asarray(box, dtype=float), 3)
+    counts = np.zeros(len(r_edges), dtype=np.int64)
+    for n in range(A.shape[0]):
+        tree_a = cKDTree(wrap_into_box(A[n], box), boxsize=box)
+        tree_b = tree_a if B is A else cKDTree(wrap_into_box(B[n], box), boxsize=box)
+        counts += tree_a.count_neighbors(tree_b, r_edges, cumulative=False)
+    # counts[0] holds the distances up to r_edges[0]
+    return counts[1:]
+
+
+def wrap_into_box(x, box):
+    # Periodic images inside [0, box), as cKDTree requires
+    x = np.mod(x, box)
+    x[x >= box] = 0.0
+    return x
+
+
+def unwrap_trajectory(x, box):
+    # Undo the jumps of x (..., 3, nframes) across the periodic boundaries of
+    # an orthorhombic box: every step longer than half a box length is taken
+    # as a jump by a whole box length. A trajectory without jumps is
+    # returned exactly.
+    box = np.broadcast_to(np.asarray(box, dtype=x.dtype), 3)[:, np.newaxis]
+    x = np.array(x)
+    jumps = np.cumsum(np.round(np.diff(x, axis=-1) / box), axis=-1)
+    x[..., 1:] -= box * jumps
+    return x
+
+
+class HistogramAccumulator:
+    """Counts of values in fixed bins, filled block by block.
+
+    Accumulators with the same edges are merged by adding their counts, so
+    the distribution of a folder is the sum of those of its trajectories,
+    whichever process or run filled them. Values outside the edges are
+    counted in underflow and overflow. save and load keep the counts in a
+    npz file, to be merged later.
+    """
+    def __init__(self, edges):
+        self.edges = np.asarray(edges, dtype=float)
+        self.counts = np.zeros(self.edges.size - 1, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+
+    def add(self, values):
+        values = np.asarray(values).ravel()
+        self.counts += np.histogram(values, bins=self.edges)[0]
+        self.underflow += int(np.count_nonzero(values < self.edges[0]))
+        self.overflow += int(np.count_nonzero(values > self.edges[-1]))
+
+    def merge(self, other):
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError("Cannot merge histograms with different bins")
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def total(self):
+        return int(self.counts.sum()) + self.underflow + self.overflow
+
+    def density(self):
+        # Normalized over all values, including those outside the bins
+        return self.counts / (max(self.total(), 1) * np.diff(self.edges))
+
+    def centers(self):
+        return 0.5 * (self.edges[1:] + self.edges[:-1])
+
+    def save(self, filename):
+        np.savez(filename, edges=self.edges, counts=self.counts, underflow=self.underflow, overflow=self.overflow)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            histogram = cls(data["edges"])
+            histogram.counts += data["counts"]
+            histogram.underflow, histogram.overflow = int(data["underflow"]), int(data["overflow"])
+        return histogram
+
+
+class WelchSpectrum:
+    """Power spectrum of a time series from the FFTs of its segments.
+
+    Samples x (..., nsamples) are added in order with add, e.g., block by
+    block from a trajectory and from the trajectories which continue it.
+    Every complete segment of nperseg samples, the segments overlapping by
+    noverlap (nperseg//2 by default), is detrended, windowed and Fourier
+    transformed (zero padded to nfft) and its power |X|^2 / sum(window^2)
+    is averaged (Welch's method). With nperseg None, the whole series is
+    one segment (a periodogram), taken when end_series is called; later
+    series are zero padded to the nfft of the first one.
+    end_series also drops an incomplete last segment, so that the next
+    samples start a new series. By the Wiener-Khinchin theorem this power
+    is the Fourier transform of the autocorrelation function, on the same
+    scale as the DCT of the autocorrelation function in
+    MD_Analysis.fft3, without computing the autocorrelation function.
+    Spectra with the same parameters are combined with merge.
+    """
+    def __init__(self, dtfs, nperseg=None, noverlap=None, nfft=None, window="hann"):
+        self.dtfs = dtfs
+        self.nperseg = nperseg
+        self.noverlap = nperseg // 2 if noverlap is None and nperseg is not None else noverlap
+        self.nfft = nfft
+        self.window = window
+        self.power = None
+        self.nsegments = 0
+        self.tail = None
+
+    def add(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        self.tail = x if self.tail is None else np.concatenate([self.tail, x], axis=-1)
+        if self.nperseg is None:
+            return
+        step = self.nperseg - self.noverlap
+        while self.tail.shape[-1] >= self.nperseg:
+            self.add_segment(self.tail[..., :self.nperseg])
+            self.tail = self.tail[..., step:]
+
+    def end_series(self):
+        if self.nperseg is None and self.tail is not None:
+            self.add_segment(self.tail)
+        self.tail = None
+
+    def add_segment(self, x):
+        n = x.shape[-1]
+        nfft = self.nfft or scipy.fft.next_fast_len(n, real=True)
+        if nfft < n:
+            raise ValueError("nfft = %d is shorter than a segment of %d samples" %(nfft, n))
+        window = signal.get_window(self.window, n)
+        power = np.abs(scipy.fft.rfft((x - np.mean(x, axis=-1, keepdims=True)) * window, nfft, axis=-1))**2
+        power /= np.sum(window**2)
+        if self.power is None:
+            self.power, self.nfft = power, nfft
+        elif power.shape != self.power.shape:
+            raise ValueError("Segments of %d and %d frequencies cannot be averaged, set nperseg or nfft"
+                             %(power.shape[-1], self.power.shape[-1]))
+        else:
+            self.power += power
+        self.nsegments += 1
+
+    def merge(self, other):
+        if (self.dtfs, self.nperseg, self.noverlap, self.window) != (other.dtfs, other.nperseg, other.noverlap, other.window):
+            raise ValueError("Cannot merge spectra with different parameters")
+        if other.power is not None:
+            if self.power is not None and self.power.shape != other.power.shape:
+                raise ValueError("Cannot merge spectra with different frequencies")
+            self.power = other.power.copy() if self.power is None else self.power + other.power
+            self.nfft = other.nfft
+            self.nsegments += other.nsegments
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def spectrum(self):
+        # Frequencies in cm^-1 and the lineshape times freq^2, as in fft3
+        if self.nsegments == 0:
+            raise ValueError("No complete segment of %s samples" %self.nperseg)
+        freq_au = scipy.fft.rfftfreq(self.nfft, self.dtfs * 1e-15)
+        freq_cminverse = freq_au / (100.0 * 299792458.0)
+        return freq_cminverse, self.power / self.nsegments * freq_au**2
+
+
+def water_geometry_histograms(bond_bins=(0.5, 1.5, 1000), angle_bins=(0.0, 180.0, 1800)):
+    # Empty O-H bond length (angstrom) and H-O-H angle (degree) histograms,
+    # bins given as (start, end, number of bins)
+    return {"OH": HistogramAccumulator(np.linspace(bond_bins[0], bond_bins[1], bond_bins[2] + 1)),
+            "HOH": HistogramAccumulator(np.linspace(angle_bins[0], angle_bins[1], angle_bins[2] + 1))}
+
+
+def output_geometry_histograms(prefix, histograms):
+    # One text file per histogram, prefix.<name>_dist.txt
+    for name, histogram in histograms.items():
+        local_filename = "%s.%s_dist.txt" %(prefix, name)
+        data = np.zeros((histogram.counts.size, 3))
+        data[:, 0] = histogram.centers()
+        data[:, 1] = histogram.counts
+        data[:, 2] = histogram.density()
+        comments = "# bins, counts, density (%d values, %d below, %d above the bins)" %(histogram.total(), histogram.underflow, histogram.overflow)
+        print("output data as %s" %local_filename)
+        np.savetxt(local_filename, data, comments=comments)
+
+
+class DerivedCache:
+    """Arrays derived from a trajectory, each computed once on demand.
+
+    Every entry has a function computing it from its dependencies, other
+    entries which are looked up (and computed if needed) first. Computed
+    entries are kept in least recently used order and, whenever their total
+    size exceeds budget bytes (None for no limit), the least recently used
+    ones are dropped; a dropped entry is computed again if it is asked for
+    again. Only the references held here are dropped, so an array which is
+    still being used elsewhere is freed once that use is over.
+    """
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.functions = {}
+        self.dependencies = {}
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def register(self, name, function, dependencies=()):
+        self.functions[name] = function
+        self.dependencies[name] = list(dependencies)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __getitem__(self, name):
+        if name in self.entries:
+            self.entries.move_to_end(name)
+            return self.entries[name]
+        value = self.functions[name](*[self[dependency] for dependency in self.dependencies[name]])
+        self.entries[name] = value
+        self.nbytes += value.nbytes
+        self.evict(keep=name)
+        return value
+
+    def evict(self, keep=None):
+        for name in list(self.entries):
+            if self.budget is None or self.nbytes <= self.budget:
+                break
+            if name != keep:
+                print("Dropping %s (%.1f MB) to stay within the memory budget" %(name, self.entries[name].nbytes / 1e6))
+                self.nbytes -= self.entries.pop(name).nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+
+# Units of the i-PI input and of the xyz comment lines
+BOHR_IN_ANGSTROM = 0.529177210903
+LENGTH_UNITS = {"angstrom": 1.0, "atomic_unit": BOHR_IN_ANGSTROM, "nanometer": 10.0}
+TIME_UNITS = {"femtosecond": 1.0, "picosecond": 1000.0, "atomic_unit": 2.418884326e-2}
+
+class XYZ_Metadata:
+    """The i-PI information of a xyz trajectory.
+
+    i-PI writes every comment line as, e.g.,
+    # CELL(abcABC):   35.23300   35.23300   35.23300   90.00000   90.00000   90.00000 Step:  4  Bead:  0 x_centroid{angstrom}  cell{atomic_unit}
+    The comment lines of the first two frames give the box (in angstrom),
+    the first step, the step stride between frames and the bead, and the
+    atom labels give the topology of water molecules (O, H, H) and photons (L).
+    Anything the analysis cannot handle raises a ValueError.
+    """
+    comment_pattern = re.compile(r"CELL\(abcABC\):\s*(?P<cell>.*?)\s+Step:\s*(?P<step>\d+)\s+Bead:\s*(?P<bead>\d+)"
+                                 r"\s+\S+\{(?P<position_unit>\w+)\}\s+cell\{(?P<cell_unit>\w+)\}")
+
+    def __init__(self, xyz_filename, comments, labels):
+        self.xyz_filename = xyz_filename
+        self.box, self.step, self.bead = self.parse_comment(comments[0])
+        self.step_stride = None
+        if len(comments) > 1:
+            box, step, bead = self.parse_comment(comments[1])
+            self.step_stride = step - self.step
+            if self.step_stride <= 0:
+                raise ValueError("%s: steps %d and %d of the first frames are not increasing" %(xyz_filename, self.step, step))
+        self.labels = labels
+        try:
+            self.topology = Topology(labels)
+        except ValueError as e:
+            raise ValueError("%s: %s" %(xyz_filename, e))
+        self.nwaters = self.topology.nwaters
+        self.nphotons = self.topology.nphotons
+
+    def parse_comment(self, comment):
+        match = self.comment_pattern.search(comment)
+        if match is None:
+            raise ValueError("%s: cannot parse the i-PI comment line %s" %(self.xyz_filename, comment.strip()))
+        if match.group("position_unit") != "angstrom":
+            raise ValueError("%s: positions are in %s, not angstrom" %(self.xyz_filename, match.group("position_unit")))
+        cell = np.array([float(x) for x in match.group("cell").split()])
+        if cell.size != 6 or np.any(np.abs(cell[3:] - 90.0) > 1e-3):
+            raise ValueError("%s: only orthorhombic cells are supported, got %s" %(self.xyz_filename, match.group("cell")))
+        box = cell[:3] * LENGTH_UNITS[match.group("cell_unit")]
+        return box, int(match.group("step")), int(match.group("bead"))
+
+    def check_frame(self, comment, n):
+        # The n-th frame must be at its expected step and in the same box,
+        # otherwise frames are missing or repeated (e.g., after a restart)
+        box, step, bead = self.parse_comment(comment)
+        if self.step_stride is not None and step != self.step + n * self.step_stride:
+            raise ValueError("%s: frame %d is at step %d instead of %d; frames are missing or repeated"
+                             %(self.xyz_filename, n, step, self.step + n * self.step_stride))
+        if not np.allclose(box, self.box):
+            raise ValueError("%s: the box changes between frame 0 and frame %d" %(self.xyz_filename, n))
+
+    def time_step_fs(self, dtfs=None):
+        # The time between frames: the step stride times the MD time step of
+        # the i-PI input next to the trajectory. A requested dtfs must agree,
+        # and is needed if there is no input.
+        timestep, stride = read_md_timestep(self.xyz_filename)
+        if timestep is None:
+            if dtfs is None:
+                raise ValueError("%s: no i-PI input next to the trajectory gives its time step, pass dtfs" %self.xyz_filename)
+            return dtfs
+        if stride is not None and self.step_stride is not None and stride != self.step_stride:
+            raise ValueError("%s: the trajectory stride of the i-PI input is %d but the frames are %d steps apart"
+                             %(self.xyz_filename, stride, self.step_stride))
+        if self.step_stride is None:
+            if dtfs is None:
+                raise ValueError("%s: a single frame has no time step" %self.xyz_filename)
+            return dtfs
+        dtfs_frames = self.step_stride * timestep
+        if dtfs is not None and abs(dtfs - dtfs_frames) > 1e-6 * dtfs_frames:
+            raise ValueError("%s: dtfs = %g fs, but the frames are %g fs apart (%d steps of %g fs)"
+                             %(self.xyz_filename, dtfs, dtfs_frames, self.step_stride, timestep))
+        return dtfs_frames
+
+
+def read_md_timestep(xyz_filename):
+    """Return the MD time step in fs and the trajectory stride of a run.
+
+    They are read from the i-PI input in the folder of the trajectory,
+    input_traj_<i>.xml for simu_<i>.xc.xyz or else input_traj.xml.bak; the
+    stride is the one of the <trajectory> whose filename wrote this file,
+    e.g., 'xc' for simu_1.xc.xyz (or simu_1.xc_0.xyz of bead 0). Both are
+    None if there is no input file. An input without that trajectory
+    raises a ValueError.
+    """
+    folder = os.path.dirname(xyz_filename)
+    basename = os.path.basename(run_filename(xyz_filename))
+    match = re.match(r"simu_(\d+)\.", basename)
+    candidates = ["input_traj.xml.bak"]
+    if match is not None:
+        candidates.insert(0, "input_traj_%s.xml" %match.group(1))
+    for name in candidates:
+        input_filename = os.path.join(folder, name)
+        if os.path.isfile(input_filename):
+            root = ET.parse(input_filename).getroot()
+            timestep = root.find(".//timestep")
+            # i-PI writes <prefix>.<filename>.xyz, or <prefix>.<filename>_<bead>.xyz
+            written = re.match(r"[^.]*\.(.+)\.xyz$", basename)
+            trajectories = [trajectory for trajectory in root.iter("trajectory") if written is not None and
+                            re.match(r"%s(_\d+)?$" %re.escape(trajectory.get("filename", "")), written.group(1))]
+            if not trajectories:
+                raise ValueError("%s: no <trajectory> of %s writes this file" %(xyz_filename, input_filename))
+            stride = int(trajectories[0].get("stride", 1))
+            return float(timestep.text) * TIME_UNITS[timestep.get("units", "atomic_unit")], stride
+    return None, None
+
+
+def read_photon_params(xyz_filename, nmodes):
+    """Return the frequencies (cm^-1) of the nmodes cavity modes and the photon mass (a.u.).
+
+    They are read from the photon_params.json of the run in the folder of
+    the trajectory. freqs_cm is either the list of the frequencies of all
+    the modes or, as in many_mode_N, the fundamental frequency, and then
+    mode k has frequency (k+1) freqs_cm. Returns None if there is no
+    photon_params.json.
+    """
+    params_filename = os.path.join(os.path.dirname(xyz_filename), "photon_params.json")
+    if not os.path.isfile(params_filename):
+        return None
+    with open(params_filename) as myfile:
+        params = json.load(myfile)
+    if params.get("n_modes", 1) != nmodes:
+        raise ValueError("%s: %d cavity modes, but the trajectory has %d" %(params_filename, params.get("n_modes", 1), nmodes))
+    freqs = np.atleast_1d(np.asarray(params["freqs_cm"], dtype=float))
+    if freqs.size == 1:
+        freqs = freqs[0] * np.arange(1, nmodes + 1)
+    elif freqs.size != nmodes:
+        raise ValueError("%s: %d frequencies for %d cavity modes" %(params_filename, freqs.size, nmodes))
+    return freqs, float(params.get("eff_mass", 1.0))
+
+
 class MD_Analysis:
-    def __init__(self, xyz_filename, dtfs = 2, nframe_max=10001):
+    def __init__(self, xyz_filename, dtfs=None, nframe_max=10001, stream=False, block_size=1000, nprocs=1, dtype=np.float64,
+                 memory_budget=None):
         self.xyz_filename = xyz_filename
+        # The outputs are named after the run, also for a compressed trajectory
+        self.run_filename = run_filename(xyz_filename)
+        # The time between frames in fs, from the i-PI metadata unless given
         self.dtfs = dtfs
-        self.dtau = dtfs * 1e-15 / 2.418884326e-17
         self.nframe_max = nframe_max
+        self.block_size = block_size
+        self.nprocs = nprocs
+        # np.float32 halves the memory of the trajectory and of the arrays
+        # stored from it; dipole sums, correlation functions and spectra are
+        # always computed in double precision
+        self.dtype = np.dtype(dtype)
         self.natoms = 0
+        self.nframes = 0
         self.labels = []
-        self.traj = []
-        self.load_xyz(self.xyz_filename)
+        self.traj = None
+        # Whether traj is loaded (load_xyz, attach_arrays) rather than only
+        # mapped from its cache by a streamed analysis
+        self.traj_loaded = False
+        # The shared memory blocks holding arrays of this analysis, see
+        # share_arrays and attach_arrays
+        self.shared_blocks = []
+        # Arrays shared by several observables, such as the trajectory stored
+        # by species, velocities and dipoles, kept within memory_budget bytes
+        self.derived_data = DerivedCache(memory_budget)
+        for name, (method, dependencies) in self.derived_arrays.items():
+            self.derived_data.register(name, getattr(self, method), dependencies)
+        if stream:
+            # Only read the header; observables which can be accumulated block
+            # by block then read the trajectory from disk with bounded memory,
+            # or from the memory mapped cache if there is one
+            self.read_xyz_info(self.xyz_filename)
+            self.traj = open_traj_cache(self.xyz_filename, self.natoms, self.labels, self.nframes, self.dtype)
+        else:
+            self.load_xyz(self.xyz_filename)
+        # The outputs already computed with these settings are skipped
+        self.results = ResultManifest(self.xyz_filename, self.frame_offsets[-1],
+                                      {"nframe_max": nframe_max, "dtype": self.dtype.name, "dtfs": self.dtfs},
+                                      self.output_versions)
         # After read xyz file, now we calculate different properties
 
     def read_xyz_info(self, xyz_filename):
         print("Reading info of atoms")
         next_n_lines = lambda file_opened, N : [x.strip() for x in islice(file_opened, N)]
         self.labels = []
-        with open(xyz_filename, 'r') as myfile:
+        with open_xyz(xyz_filename) as myfile:
             self.natoms = int(myfile.readline().strip())
-            myfile.readline()
+            comments = [myfile.readline().decode()]
             data = next_n_lines(myfile, self.natoms)
             for i in range(self.natoms):
-                self.labels.append( data[i].split()[0] )
+                self.labels.append( data[i].split()[0].decode() )
+            # The comment line of the 2nd frame gives the step stride
+            comments += [x.decode() for x in islice(myfile, 1, 2)]
+        self.metadata = XYZ_Metadata(xyz_filename, comments, self.labels)
+        self.topology = self.metadata.topology
+        self.nwaters = self.metadata.nwaters
+        self.dtfs = self.metadata.time_step_fs(self.dtfs)
+        self.dtau = self.dtfs * 1e-15 / 2.418884326e-17
+        # Compressed trajectories are decoded sequentially
+        self.seekable = not is_compressed(xyz_filename)
+        # Byte offset of each complete frame, which gives the exact number of frames
+        self.frame_offsets = load_xyz_index(xyz_filename, self.natoms)
+        self.nframes = min(self.frame_offsets.size - 1, self.nframe_max)
+        print("Found %d complete frames" %self.nframes)
+        if self.seekable and self.nframes > 1:
+            with open(xyz_filename, 'rb') as myfile:
+                myfile.seek(self.frame_offsets[self.nframes-1])
+                myfile.readline()
+                self.metadata.check_frame(myfile.readline().decode(), self.nframes-1)
 
     def load_xyz(self, xyz_filename):
         # Load info of how many water molecules are available
         self.read_xyz_info(xyz_filename)
         # Load trajectory
-        try:
-            print("Try to load file from %s.npy" %xyz_filename)
-            self.traj = np.load("%s.npy" %xyz_filename)
-            print("Loaded file from %s.npy" %xyz_filename)
-        except:
-            next_n_data = lambda file_opened, N : [x.strip().split()[1:] for x in islice(file_opened, N)]
-            self.traj = np.zeros((self.natoms, 3, self.nframe_max))
+        self.traj = open_traj_cache(xyz_filename, self.natoms, self.labels, self.nframes, self.dtype)
+        if self.traj is not None:
+            print("Loaded file from %s.npy" %traj_cache_prefix(xyz_filename, self.dtype))
+            self.nframes = self.traj.shape[-1]
+            self.traj_loaded = True
+            return
+        source = source_identity(xyz_filename)
+        nframes_requested = self.nframes
+        if self.nprocs > 1 and self.seekable:
+            print("Reading trajs with %d processes ..." %self.nprocs)
+            self.traj, self.traj_shm = load_xyz_parallel(xyz_filename, self.natoms, self.frame_offsets,
+                                                         self.nframes, self.nprocs, self.block_size, self.dtype)
+            n = self.traj.shape[-1]
+        else:
+            self.traj = np.zeros((self.natoms, 3, self.nframes), dtype=self.dtype)
             print("Reading trajs ...")
-            with open(xyz_filename, 'r') as myfile:
-                for n in range(self.nframe_max):
-                    try:
-                        data = next_n_data(myfile, self.natoms+2)[2:]
-                        coords = np.asarray(data).astype(np.float)
-                        self.traj[:, :, n] = coords
-                        if (n % 1000 == 0):
-                            print("Finish No.%d frame" %n)
-                    except:
-                        print("Read No.%d frame but has error" %n)
-                        break
-            # Save data
-            np.save(xyz_filename + ".npy", self.traj)
+            n = 0
+            for block in iter_xyz_blocks(xyz_filename, self.natoms, self.block_size, self.nframes,
+                                         offsets=self.frame_offsets if self.seekable else None, dtype=self.dtype):
+                self.traj[:, :, n:n+block.shape[0]] = block.transpose(1, 2, 0)
+                n += block.shape[0]
+                print("Finish No.%d frame" %n)
+        if n < self.nframes:
+            self.traj = self.traj[:, :, :n]
+            self.nframes = n
+        self.traj_loaded = True
+        # Save data
+        if CACHE_COMPRESSED_TRAJECTORIES or not is_compressed(xyz_filename):
+            save_traj_cache(xyz_filename, self.traj, self.labels, nframes_requested, source)
 
-    def cacl_center_of_mass_water_traj(self):
-        print("Calculating Center of Mass traj of water")
-        self.nwaters = 216
+    def require_traj(self):
+        # Observables which need the whole trajectory at once load it on demand
+        if self.traj is None:
+            self.load_xyz(self.xyz_filename)
+
+    def share_arrays(self, layouts=("time",)):
+        """Move the trajectory and its layouts (see Trajectory) into shared memory.
+
+        Returns {name: (block name, shape, dtype)}, with which other
+        processes attach the same arrays without a copy (attach_arrays). A
+        trajectory memory mapped from its cache is not copied, the other
+        processes map the cache as well. The caller unlinks the blocks,
+        kept in shared_blocks, once the other processes have attached.
+        """
+        self.require_traj()
+        shared = {}
+        if not isinstance(self.traj, np.memmap):
+            traj, shm = shared_array(self.traj.shape, self.traj.dtype)
+            traj[...] = self.traj
+            self.traj = traj
+            self.shared_blocks.append(shm)
+            shared["traj"] = (shm.name, traj.shape, traj.dtype.str)
+        self.derived_data.clear()
+        for layout in layouts:
+            shape = self.traj.shape if layout == "time" else (self.nframes, self.natoms, 3)
+            data, shm = shared_array(shape, self.traj.dtype)
+            self.shared_blocks.append(shm)
+            shared["traj_%s" %layout] = (shm.name, data.shape, data.dtype.str)
+            trajectory = Trajectory(self.traj, self.topology, layout, self.block_size, data=data)
+            self.derived_data.register("traj_%s" %layout, lambda trajectory=trajectory: trajectory)
+        return shared
+
+    def attach_arrays(self, shared):
+        # Use the arrays which share_arrays put in shared memory in another
+        # process instead of loading and reordering the trajectory here
+        self.derived_data.clear()
+        for name, (block, shape, dtype) in shared.items():
+            data, shm = attach_shared_array(block, shape, dtype)
+            self.shared_blocks.append(shm)
+            self.nframes = shape[0] if name == "traj_frame" else shape[-1]
+            if name == "traj":
+                self.traj = data
+            else:
+                trajectory = Trajectory(None, self.topology, name[len("traj_"):], self.block_size, data=data)
+                self.derived_data.register(name, lambda trajectory=trajectory: trajectory)
+        self.traj_loaded = True
+
+    def release_arrays(self):
+        # Drop the arrays in shared memory and close their blocks; the
+        # trajectory is loaded again if it is needed afterwards
+        self.traj = None
+        self.traj_loaded = False
+        self.derived_data.clear()
+        self.derived_data.register("traj_time", self.compute_traj_time)
+        self.derived_data.register("traj_frame", self.compute_traj_frame)
+        for shm in self.shared_blocks:
+            shm.close()
+        self.shared_blocks = []
+
+    def species_traj(self, layout="time"):
+        # The loaded trajectory stored by species in the given layout, built
+        # once and shared by all observables which need this layout
+        return self.derived("traj_%s" %layout)
+
+    def traj_blocks(self, atoms=None, start=0, stop=None, step=1):
+        # Yield frames start:stop:step of the selected atoms (a slice or an
+        # index array) as (block, natoms, 3) arrays, either from the frame
+        # major layout of the loaded trajectory, from its memory mapped cache
+        # or streamed from disk with bounded memory, in which case nothing
+        # else is decoded. The frame index only checks the atom count lines,
+        # so a stream which stops at a broken frame sets nframes to it
+        stop = self.nframes if stop is None else min(stop, self.nframes)
+        if self.traj_loaded:
+            for block in self.species_traj("frame").blocks(atoms, start, stop, step, self.block_size):
+                yield block
+        elif self.traj is None:
+            nread = 0
+            for block in iter_xyz_blocks(self.xyz_filename, self.natoms, self.block_size, stop,
+                                         offsets=self.frame_offsets if self.seekable else None, dtype=self.dtype,
+                                         atoms=atoms, start=start, step=step):
+                nread += block.shape[0]
+                yield block
+            if nread < len(range(start, stop, step)):
+                self.nframes = min(self.nframes, start + nread*step)
+                print("Using the %d frames before the broken one" %self.nframes)
+        else:
+            traj = self.traj if atoms is None else self.traj[atoms]
+            stop = min(stop, traj.shape[-1])
+            for n in range(start, stop, self.block_size*step):
+                yield traj[:, :, n:min(n+self.block_size*step, stop):step].transpose(2, 0, 1)
+
+    # The method computing each derived array and the derived arrays it is
+    # computed from
+    derived_arrays = {"traj_time": ("compute_traj_time", []),
+                      "traj_frame": ("compute_traj_frame", []),
+                      "com_traj": ("compute_com_traj", ["traj_time"]),
+                      "com_velocity": ("compute_com_velocity", ["com_traj"]),
+                      "O_velocity": ("compute_O_velocity", ["traj_time"]),
+                      "H_velocity": ("compute_H_velocity", ["traj_time"]),
+                      "OH_velocity": ("compute_OH_velocity", ["traj_time"]),
+                      "unit_dipoles": ("compute_unit_dipoles", ["traj_time"]),
+                      "orientation_acf": ("compute_orientation_acf", ["unit_dipoles"]),
+                      "photon_traj": ("compute_photon_traj", ["traj_time"])}
+
+    # Size of each derived array in units of the size of the trajectory
+    derived_sizes = {"traj_time": 1.0, "traj_frame": 1.0, "com_traj": 1/3.0, "com_velocity": 1/3.0,
+                     "O_velocity": 1/3.0, "H_velocity": 1/3.0, "OH_velocity": 1/3.0, "unit_dipoles": 1/3.0,
+                     "orientation_acf": 0.0, "photon_traj": 0.0}
+
+    # The derived arrays each output uses and the size of its other temporary
+    # arrays in units of the size of the trajectory, for estimate_task_memory;
+    # the outputs not listed here only need blocks of frames, which they read
+    # from the "frame" layout once the trajectory is loaded (traj_blocks)
+    memory_use = {"vac": (["com_velocity"], 1.0),
+                  "msd": (["com_traj"], 1.0),
+                  "Ovac": (["O_velocity"], 0.2),
+                  "Hvac": (["H_velocity"], 0.2),
+                  "OHvac": (["OH_velocity"], 0.5),
+                  "dac_molecules": (["traj_time"], 1.0),
+                  "oac1": (["orientation_acf"], 1.9),
+                  "oac2": (["orientation_acf"], 1.9),
+                  "photon_acf": (["photon_traj"], 0.0),
+                  "photon_energy": (["photon_traj"], 0.0)}
+
+    # The runtime of each output in seconds per 1000 frames of 650 atoms,
+    # including its derived arrays, for observable_groups; the
+    # outputs not listed here take about 0.01 s
+    output_runtimes = {"rdf": 22.0, "pair_dist": 0.3, "oac1": 0.13, "oac2": 0.12, "vac": 0.09, "msd": 0.07,
+                       "Ovac": 0.05, "Hvac": 0.05, "OHvac": 0.05, "dac_molecules": 0.05}
+
+    # Highest Legendre order of the orientation correlation functions
+    orientation_lmax = 2
+
+    def derived(self, name):
+        # A derived array, computed on first use and kept while it fits in the
+        # memory budget (see DerivedCache)
+        return self.derived_data[name]
+
+    def compute_traj_time(self):
+        self.require_traj()
+        return Trajectory(self.traj, self.topology, "time", self.block_size)
+
+    def compute_traj_frame(self):
+        self.require_traj()
+        return Trajectory(self.traj, self.topology, "frame", self.block_size)
+
+    def compute_com_traj(self, traj):
+        # Each atom is unwrapped before the average, so that the center of mass
+        # of a molecule split by the box is right too
         mO, mH, mD = 15.9994, 1.00794, 2.0141
-        O_traj = self.traj[0:self.nwaters*3:3, :, :]
-        H1_traj = self.traj[1:self.nwaters*3:3, :, :]
-        H2_traj = self.traj[2:self.nwaters*3:3, :, :]
-        self.com_water_traj = (O_traj * mO + H1_traj * mH + H2_traj * mH) / (mO + mH + mH)
+        box = self.metadata.box
+        com_water_traj = unwrap_trajectory(traj.O, box) * mO
+        com_water_traj += unwrap_trajectory(traj.H1, box) * mH
+        com_water_traj += unwrap_trajectory(traj.H2, box) * mH
+        com_water_traj /= (mO + mH + mH)
+        return com_water_traj
+
+    def compute_com_velocity(self, com_water_traj):
+        print("Calculating the gradient")
+        return np.gradient(com_water_traj, self.dtfs, axis=-1, edge_order=2)
+
+    def compute_O_velocity(self, traj):
+        print("Calculating the gradient")
+        return np.gradient(traj.O, self.dtfs, axis=-1, edge_order=2)
+
+    def compute_H_velocity(self, traj):
         print("Calculating the gradient")
-        self.com_water_velocity = np.gradient(self.com_water_traj, self.dtfs, axis=-1, edge_order=2)
+        return np.gradient(traj.H1, self.dtfs, axis=-1, edge_order=2)
+
+    def compute_OH_velocity(self, traj):
+        print("Calculating the gradient")
+        return np.gradient(traj.O - traj.H1, self.dtfs, axis=-1, edge_order=2)
+
+    def compute_photon_traj(self, traj):
+        # The field coordinate of each photon, its coordinate along its
+        # polarization, (nphotons, nframes) in angstrom
+        return traj.photons[np.arange(self.topology.nphotons), self.topology.polarization]
+
+    def compute_unit_dipoles(self, traj):
+        # The unit vector along the dipole moment direction of each molecule
+        dipoles = -traj.O * 2.0 + traj.H1 + traj.H2
+        dipoles /= np.sqrt(np.sum(dipoles**2, axis=1))[:, np.newaxis, :]
+        return dipoles
+
+    def cacl_center_of_mass_water_traj(self):
+        print("Calculating Center of Mass traj of water")
+        velocity = self.derived("com_velocity")
         print("Calculating the autocorrelation function...")
-        self.vacf_x, self.vacf_y, self.vacf_z = [], [], []
-        for i in range(self.nwaters):
-            self.vacf_x.append( self.auto_correlation_function_simple(self.com_water_velocity[i, 0, :]) )
-            self.vacf_y.append( self.auto_correlation_function_simple(self.com_water_velocity[i, 1, :]) )
-            self.vacf_z.append( self.auto_correlation_function_simple(self.com_water_velocity[i, 2, :]) )
-        self.vacf_x = np.mean(np.array(self.vacf_x), axis=0)
-        self.vacf_y = np.mean(np.array(self.vacf_y), axis=0)
-        self.vacf_z = np.mean(np.array(self.vacf_z), axis=0)
+        acf = self.auto_correlation_function_batch(velocity)
+        self.vacf_x, self.vacf_y, self.vacf_z = np.mean(acf, axis=0)
         self.vacf_tot = self.vacf_x + self.vacf_y + self.vacf_z
         self.vacf_time_fs = np.linspace(0.0, self.dtfs*(self.vacf_x.size -1), self.vacf_x.size)
         print("Calculating the FFT of autocorrelation function")
@@ -131,25 +1462,52 @@ class MD_Analysis:
         self.vacf_z_freq, self.vacf_z_sp = self.fft(self.vacf_z)
         self.vacf_tot_freq, self.vacf_tot_sp = self.fft(self.vacf_tot)
 
+    def cacl_msd_water_traj(self, fit_range=(0.5, 1.0)):
+        print("Calculating mean square displacement of water")
+        msd = np.mean(self.mean_square_displacement_batch(self.derived("com_traj")), axis=0)
+        self.msd_x, self.msd_y, self.msd_z = msd
+        self.msd_tot = self.msd_x + self.msd_y + self.msd_z
+        self.msd_time_fs = np.linspace(0.0, self.dtfs*(self.msd_x.size -1), self.msd_x.size)
+        # Einstein relation, msd_tot = 6 D t over the fit_range part of the lags,
+        # in A^2/ps as printed by plot_diffusion.py from the vacf
+        fit = slice(int(fit_range[0] * self.msd_tot.size), int(fit_range[1] * self.msd_tot.size))
+        self.msd_diffusion = np.polyfit(self.msd_time_fs[fit], self.msd_tot[fit], 1)[0] / 6.0 * 1e3
+        print("diffusion constant from the msd is %.3E" %self.msd_diffusion)
+
+    def cacl_Ovelocity_water_traj(self):
+        print("Calculating Oxygen velocity traj of water")
+        velocity = self.derived("O_velocity")
+        print("Calculating the autocorrelation function...")
+        acf = self.auto_correlation_function_batch(velocity)
+        self.vacf_Ox, self.vacf_Oy, self.vacf_Oz = np.mean(acf, axis=0)
+        self.vacf_Otot = self.vacf_Ox + self.vacf_Oy + self.vacf_Oz
+        self.vacf_time_fs_O = np.linspace(0.0, self.dtfs*(self.vacf_Ox.size -1), self.vacf_Ox.size)
+        print("Calculating the FFT of autocorrelation function")
+        self.vacf_Ox_freq, self.vacf_Ox_sp = self.fft(self.vacf_Ox)
+        self.vacf_Oy_freq, self.vacf_Oy_sp = self.fft(self.vacf_Oy)
+        self.vacf_Oz_freq, self.vacf_Oz_sp = self.fft(self.vacf_Oz)
+        self.vacf_Otot_freq, self.vacf_Otot_sp = self.fft(self.vacf_Otot)
+
+    def cacl_Hvelocity_water_traj(self):
+        print("Calculating Hydrogen velocity traj of water")
+        velocity = self.derived("H_velocity")
+        print("Calculating the autocorrelation function...")
+        acf = self.auto_correlation_function_batch(velocity)
+        self.vacf_Hx, self.vacf_Hy, self.vacf_Hz = np.mean(acf, axis=0)
+        self.vacf_Htot = self.vacf_Hx + self.vacf_Hy + self.vacf_Hz
+        self.vacf_time_fs_H = np.linspace(0.0, self.dtfs*(self.vacf_Hx.size -1), self.vacf_Hx.size)
+        print("Calculating the FFT of autocorrelation function")
+        self.vacf_Hx_freq, self.vacf_Hx_sp = self.fft(self.vacf_Hx)
+        self.vacf_Hy_freq, self.vacf_Hy_sp = self.fft(self.vacf_Hy)
+        self.vacf_Hz_freq, self.vacf_Hz_sp = self.fft(self.vacf_Hz)
+        self.vacf_Htot_freq, self.vacf_Htot_sp = self.fft(self.vacf_Htot)
+
     def cacl_OHvelocity_water_traj(self):
         print("Calculating OH velocity traj of water")
-        self.nwaters = 216
-        mO, mH = 15.9994, 1.00794
-        O_traj = self.traj[0:self.nwaters*3:3, :, :]
-        H1_traj = self.traj[1:self.nwaters*3:3, :, :]
-        H2_traj = self.traj[2:self.nwaters*3:3, :, :]
-        self.OH_water_traj = O_traj - H1_traj
-        print("Calculating the gradient")
-        self.OH_water_velocity = np.gradient(self.OH_water_traj, self.dtfs, axis=-1, edge_order=2)
+        velocity = self.derived("OH_velocity")
         print("Calculating the autocorrelation function...")
-        self.vacf_OHx, self.vacf_OHy, self.vacf_OHz = [], [], []
-        for i in range(self.nwaters):
-            self.vacf_OHx.append( self.auto_correlation_function_simple(self.OH_water_velocity[i, 0, :]) )
-            self.vacf_OHy.append( self.auto_correlation_function_simple(self.OH_water_velocity[i, 1, :]) )
-            self.vacf_OHz.append( self.auto_correlation_function_simple(self.OH_water_velocity[i, 2, :]) )
-        self.vacf_OHx = np.mean(np.array(self.vacf_OHx), axis=0)
-        self.vacf_OHy = np.mean(np.array(self.vacf_OHy), axis=0)
-        self.vacf_OHz = np.mean(np.array(self.vacf_OHz), axis=0)
+        acf = self.auto_correlation_function_batch(velocity)
+        self.vacf_OHx, self.vacf_OHy, self.vacf_OHz = np.mean(acf, axis=0)
         self.vacf_OHtot = self.vacf_OHx + self.vacf_OHy + self.vacf_OHz
         self.vacf_time_fs_OH = np.linspace(0.0, self.dtfs*(self.vacf_OHx.size -1), self.vacf_OHx.size)
         print("Calculating the FFT of autocorrelation function")
@@ -162,19 +1520,19 @@ class MD_Analysis:
         print("Calculating dipole of water")
         cO, cH = -1.0, 0.5
         if which_molecule == None:
-            self.nwaters = 216
-            O_traj = self.traj[0:self.nwaters*3:3, :, :]
-            H1_traj = self.traj[1:self.nwaters*3:3, :, :]
-            H2_traj = self.traj[2:self.nwaters*3:3, :, :]
+            atoms = self.topology.water_atoms
         else:
-            O_traj = self.traj[3*which_molecule:3*which_molecule+3:3, :, :]
-            H1_traj = self.traj[3*which_molecule+1:3*which_molecule+3:3, :, :]
-            H2_traj = self.traj[3*which_molecule+2:3*which_molecule+3:3, :, :]
-        self.dipole_water_traj = np.sum(O_traj * cO + H1_traj * cH + H2_traj * cH, axis=0)
+            atoms = self.topology.molecule_atoms(which_molecule)
+        # The total dipole is only 3 numbers per frame, so accumulate it block
+        # by block, reading only the atoms of the selected water molecules;
+        # the sums are in double precision also for a float32 trajectory
+        dipole_blocks = []
+        for block in self.traj_blocks(atoms=atoms):
+            block = block.astype(np.float64, copy=False)
+            dipole_blocks.append(np.sum(block[:, 0::3, :] * cO + block[:, 1::3, :] * cH + block[:, 2::3, :] * cH, axis=1))
+        self.dipole_water_traj = np.concatenate(dipole_blocks, axis=0).T
         print("Calculating the autocorrelation function...")
-        self.dacf_x = self.auto_correlation_function_simple(self.dipole_water_traj[0,:])
-        self.dacf_y = self.auto_correlation_function_simple(self.dipole_water_traj[1,:])
-        self.dacf_z = self.auto_correlation_function_simple(self.dipole_water_traj[2,:])
+        self.dacf_x, self.dacf_y, self.dacf_z = self.auto_correlation_function_batch(self.dipole_water_traj)
         self.dacf_tot = self.dacf_x + self.dacf_y + self.dacf_z
         self.dacf_time_fs = np.linspace(0.0, self.dtfs*(self.dacf_x.size -1), self.dacf_x.size)
         print("Calculating the FFT of autocorrelation function")
@@ -183,29 +1541,113 @@ class MD_Analysis:
         self.dacf_z_freq, self.dacf_z_sp = self.fft3(self.dacf_z)
         self.dacf_tot_freq, self.dacf_tot_sp = self.fft3(self.dacf_tot)
 
+    def accumulate_dipole_spectrum(self, spectrum, end_series=True):
+        # Add the total dipole of all frames to a WelchSpectrum, block by block;
+        # with end_series=False, the next trajectory added continues this one
+        cO, cH = -1.0, 0.5
+        for block in self.traj_blocks(atoms=self.topology.water_atoms):
+            block = block.astype(np.float64, copy=False)
+            spectrum.add(np.sum(block[:, 0::3, :] * cO + block[:, 1::3, :] * cH + block[:, 2::3, :] * cH, axis=1).T)
+        if end_series:
+            spectrum.end_series()
+        return spectrum
+
+    def cacl_dipole_spectrum_welch(self, nperseg=2048, noverlap=None, nfft=None, window="hann"):
+        print("Calculating dipole spectrum of water by Welch's method")
+        nframes = self.nframes
+        spectrum = self.accumulate_dipole_spectrum(WelchSpectrum(self.dtfs, None if nperseg is None else min(nperseg, nframes),
+                                                                 noverlap, nfft, window))
+        if nperseg is not None and self.nframes < min(nperseg, nframes):
+            # Fewer frames than indexed could be read, see traj_blocks
+            spectrum = self.accumulate_dipole_spectrum(WelchSpectrum(self.dtfs, self.nframes, noverlap, nfft, window))
+        self.dsp_freq, sp = spectrum.spectrum()
+        self.dsp_x, self.dsp_y, self.dsp_z = sp
+        self.dsp_tot = self.dsp_x + self.dsp_y + self.dsp_z
+
+    def cacl_photon_autocorrelation(self):
+        # The displacement autocorrelation function and its spectrum for every
+        # photon, from one batched FFT and one DCT over all the photons
+        print("Calculating photon displacement autocorrelation functions")
+        self.pacf = self.auto_correlation_function_batch(self.derived("photon_traj"))
+        self.pacf_time_fs = np.linspace(0.0, self.dtfs*(self.pacf.shape[-1] -1), self.pacf.shape[-1])
+        print("Calculating the FFT of autocorrelation functions")
+        self.pacf_freq = self.fft(self.pacf[0])[0]
+        self.pacf_sp = fftpack.dct(self.pacf.astype(np.float64, copy=False), type=1, axis=-1)
+
+    def cacl_photon_energy(self):
+        # The energy of each photon as a cavity oscillator, p^2/2m + m w^2 q^2/2
+        # in Hartree, with the velocity from the trajectory; the coupling to
+        # the water dipole needs the force field charges and is not included
+        print("Calculating photon energies")
+        params = read_photon_params(self.xyz_filename, self.topology.nmodes)
+        if params is None:
+            raise ValueError("%s: the photon energy needs the photon_params.json of the run" %self.xyz_filename)
+        freqs_cm, mass = params
+        omega = freqs_cm[np.arange(self.topology.nphotons) // 2] / 219474.63
+        q = self.derived("photon_traj") / BOHR_IN_ANGSTROM
+        velocity = np.gradient(q, self.dtau, axis=-1, edge_order=2)
+        self.photon_energy = 0.5 * mass * (velocity**2 + (omega**2)[:, np.newaxis] * q**2)
+        self.photon_energy_time_fs = np.linspace(0.0, self.dtfs*(q.shape[-1] -1), q.shape[-1])
+
+    def cacl_molecular_dipole_spectra(self):
+        # The dipole autocorrelation function and spectrum of every molecule,
+        # as output_dipole_autocorrelation(which_molecule=i) gives for one
+        # molecule, from one batched FFT and one DCT over all the molecules
+        print("Calculating dipole of every water molecule")
+        cO, cH = -1.0, 0.5
+        traj = self.derived("traj_time")
+        dipoles = traj.O.astype(np.float64) * cO
+        dipoles += traj.H1 * cH
+        dipoles += traj.H2 * cH
+        print("Calculating the autocorrelation functions...")
+        self.dacf_molecules = np.sum(self.auto_correlation_function_batch(dipoles), axis=1)
+        del dipoles
+        self.dacf_molecules_time_fs = np.linspace(0.0, self.dtfs*(self.dacf_molecules.shape[-1] -1), self.dacf_molecules.shape[-1])
+        print("Calculating the FFT of autocorrelation functions")
+        self.dacf_molecules_freq = self.fft3(self.dacf_molecules[0])[0]
+        freq_au = np.linspace(0, 0.5/self.dtfs * 1e15, self.dacf_molecules.shape[-1])
+        self.dacf_molecules_sp = fftpack.dct(self.dacf_molecules.astype(np.float64, copy=False), type=1, axis=-1) * freq_au**2
+
+    def orientation_correlation(self, u, orders=(1, 2)):
+        """Legendre orientation correlation functions <P_l(u(0).u(t))>.
+
+        u is an (nmolecules, 3, nframes) array of unit vectors. By the
+        multinomial theorem, (u(0).u(t))^m is the sum over a+b+c = m of
+        m!/(a!b!c!) ux^a uy^b uz^c (0) ux^a uy^b uz^c (t), so every power, and
+        hence P_l for any l, is a combination of the autocorrelation functions
+        of the monomials ux^a uy^b uz^c, the components of the symmetric
+        tensor products of u. These are computed for all the molecules and
+        all the orders at once with auto_correlation_function_batch. Returns
+        the molecule averaged autocorrelation functions of the x, y and z
+        components and a dict of P_l for l in orders.
+        """
+        coefficients = dict((l, np.polynomial.legendre.leg2poly([0]*l + [1])) for l in orders)
+        degrees = sorted(set([1] + [m for l in orders for m in range(1, l + 1) if coefficients[l][m] != 0.0]))
+        monomials = [(a, b, m - a - b) for m in degrees for a in range(m, -1, -1) for b in range(m - a, -1, -1)]
+        products = np.empty((u.shape[0], len(monomials), u.shape[-1]), dtype=u.dtype)
+        for k, powers in enumerate(monomials):
+            products[:, k] = np.prod([u[:, j]**powers[j] for j in range(3)], axis=0)
+        acf = np.mean(self.auto_correlation_function_batch(products), axis=0)
+        del products
+        moments = dict((m, np.zeros(acf.shape[-1], dtype=acf.dtype)) for m in degrees)
+        for k, (a, b, c) in enumerate(monomials):
+            moments[a + b + c] += math.factorial(a + b + c) // (math.factorial(a) * math.factorial(b) * math.factorial(c)) * acf[k]
+        correlations = {}
+        for l in orders:
+            correlations[l] = np.full(acf.shape[-1], coefficients[l][0], dtype=acf.dtype) + sum(coefficients[l][m] * moments[m] for m in range(1, l + 1) if coefficients[l][m] != 0.0)
+        return acf[:3], correlations
+
+    def compute_orientation_acf(self, dipoles):
+        # Rows x, y, z, P_1, ..., P_lmax of the dipole orientation correlation,
+        # shared by oac1 and oac2
+        print("Calculating the autocorrelation function...")
+        orders = range(1, self.orientation_lmax + 1)
+        components, correlations = self.orientation_correlation(dipoles, orders)
+        return np.concatenate([components, [correlations[l] for l in orders]])
+
     def cacl_orientation_water_traj(self):
         print("Calculating orientation correlation function of water")
-        self.nwaters = 216
-        #self.cacl_center_of_mass_water_traj()
-        mO, mH = 15.9994, 1.00794
-        O_traj = self.traj[0:self.nwaters*3:3, :, :]
-        H1_traj = self.traj[1:self.nwaters*3:3, :, :]
-        H2_traj = self.traj[2:self.nwaters*3:3, :, :]
-        # Calculate the unit vector along the dipole moment direction
-        self.dipoles = -O_traj * 2.0 + H1_traj + H2_traj
-        self.dipoles_length = np.sqrt(np.sum(self.dipoles**2, axis=1))
-        self.dipoles[:,0,:] /= self.dipoles_length
-        self.dipoles[:,1,:] /= self.dipoles_length
-        self.dipoles[:,2,:] /= self.dipoles_length
-        print("Calculating the autocorrelation function...")
-        self.oacfz_x, self.oacfz_y, self.oacfz_z = [], [], []
-        for i in range(self.nwaters):
-            self.oacfz_x.append( self.auto_correlation_function_simple(self.dipoles[i, 0, :]) )
-            self.oacfz_y.append( self.auto_correlation_function_simple(self.dipoles[i, 1, :]) )
-            self.oacfz_z.append( self.auto_correlation_function_simple(self.dipoles[i, 2, :]) )
-        self.oacfz_x = np.mean(np.array(self.oacfz_x), axis=0)
-        self.oacfz_y = np.mean(np.array(self.oacfz_y), axis=0)
-        self.oacfz_z = np.mean(np.array(self.oacfz_z), axis=0)
+        self.oacfz_x, self.oacfz_y, self.oacfz_z = self.derived("orientation_acf")[:3]
         self.oacfz_tot = self.oacfz_x + self.oacfz_y + self.oacfz_z
         self.oacfz_time_fs = np.linspace(0.0, self.dtfs*(self.oacfz_x.size -1), self.oacfz_x.size)
         print("Calculating the FFT of autocorrelation function")
@@ -214,39 +1656,97 @@ class MD_Analysis:
         self.oacfz_z_freq, self.oacfz_z_sp = self.fft3(self.oacfz_z)
         self.oacfz_tot_freq, self.oacfz_tot_sp = self.fft3(self.oacfz_tot)
 
+    def cacl_orientation_water_traj2(self):
+        print("Calculating orientation correlation function of water")
+        # P_2 = 1.5 (xx + 2xy + 2xz + yy + 2yz + zz) - 0.5
+        self.oacfz2_tot = self.derived("orientation_acf")[3 + 1]
+        self.oacfz2_time_fs = np.linspace(0.0, self.dtfs*(self.oacfz2_tot.size -1), self.oacfz2_tot.size)
+        print("Calculating the FFT of autocorrelation function")
+        self.oacfz2_tot_freq, self.oacfz2_tot_sp = self.fft3(self.oacfz2_tot)
+
     def calc_bond_length_dist(self, bin_start=0.1, bin_end=4, bin_num=1000):
-        self.nwaters = 216
-        O_traj = self.traj[0:self.nwaters*3:3, :, :]
-        H1_traj = self.traj[1:self.nwaters*3:3, :, :]
-        H2_traj = self.traj[2:self.nwaters*3:3, :, :]
         bond_bins = np.linspace(bin_start, bin_end, bin_num)
         print("Calculating Bond length distribution of water")
-        OH = O_traj - H1_traj
-        data = np.sqrt(np.sum(np.abs(O_traj - H1_traj)**2, axis=1))
-        print("preparing data")
-        self.bond_statistics, self.bond_bins = np.histogram(data, bins=bond_bins)
-
-    def calc_pair_dist_OO(self, bin_start=0.1, bin_end=9.0, bin_num=1000, cell_length=18.6445):
-        self.nwaters = 216
-        O_traj = self.traj[0:self.nwaters*3:3, :, 1:-1:10]
-        H1_traj = self.traj[1:self.nwaters*3:3, :, 1:-1:10]
-        H2_traj = self.traj[2:self.nwaters*3:3, :, 1:-1:10]
+        histogram = HistogramAccumulator(bond_bins)
+        for block in self.traj_blocks(atoms=self.topology.water_atoms):
+            O_traj = block[:, 0::3, :]
+            H1_traj = block[:, 1::3, :]
+            histogram.add(np.sqrt(np.sum(np.abs(O_traj - H1_traj)**2, axis=-1)))
+        self.bond_statistics = histogram.counts
+        self.bond_bins = bond_bins
+
+    def accumulate_geometry(self, histograms):
+        """Add the O-H bond lengths and H-O-H angles of all frames.
+
+        histograms is a dict as made by water_geometry_histograms, with the
+        "OH" (both bonds of every molecule, in angstrom) and "HOH" (in
+        degree) accumulators filled here; passing the same dict for several
+        trajectories gives their combined distributions. Bonds are taken
+        as minimum images, so molecules split by the box are also right.
+        """
+        print("Accumulating bond length and angle distributions of water")
+        box = np.broadcast_to(self.metadata.box, 3)
+        for block in self.traj_blocks(atoms=self.topology.water_atoms):
+            bonds = block[:, 1::3, None, :].repeat(2, axis=2)
+            bonds[:, :, 1] = block[:, 2::3]
+            bonds -= block[:, 0::3, None, :]
+            bonds -= box * np.round(bonds / box)
+            lengths = np.sqrt(np.sum(bonds**2, axis=-1))
+            cosine = np.sum(bonds[:, :, 0] * bonds[:, :, 1], axis=-1) / (lengths[:, :, 0] * lengths[:, :, 1])
+            histograms["OH"].add(lengths)
+            histograms["HOH"].add(np.degrees(np.arccos(np.clip(cosine, -1.0, 1.0))))
+        return histograms
+
+    def calc_pair_dist_OO(self, bin_start=0.1, bin_end=9.0, bin_num=1000, cell_length=None):
+        # The box is taken from the trajectory unless cell_length is given
+        cell_length = self.metadata.box if cell_length is None else np.asarray(cell_length)
         r_bins = np.linspace(bin_start, bin_end, bin_num)
         print("Calculating pari distribution function of water O-O")
         self.OOstatstics = np.zeros(np.size(r_bins)-1)
-        for i in range(self.nwaters):
-            for j in range(self.nwaters):
-                OO_traj = np.abs(O_traj[i, :, :] - O_traj[j, :, :]) % cell_length
-                OO_traj[OO_traj >= cell_length / 2.0] -= cell_length
-                distance_oo = np.sqrt(np.sum(OO_traj**2, axis=0))
-                oo, self.r_bins = np.histogram(distance_oo, bins=r_bins)
-                oo = oo.astype(np.float)
-                self.OOstatstics += oo
+        self.r_bins = r_bins
+        # Use every 10th frame starting from the 2nd one but not the last frame
+        # (frames 1:-1:10), and only read the oxygens of these frames; when
+        # streamed, a broken frame ends them (and nframes) only if it is read
+        nframes_used = 0
+        for O_traj in self.traj_blocks(atoms=self.topology.O_atoms, start=1, stop=self.nframes-1,
+                                       step=self.frame_strides["pair_dist"]):
+            self.OOstatstics += pair_distance_counts(O_traj, O_traj, r_bins, cell_length)
+            nframes_used += O_traj.shape[0]
         # post process
         self.OOstatstics /= float(self.nwaters)
         self.OOstatstics /= 4.0 * np.pi * r_bins[1:]**2 * (r_bins[2] - r_bins[1])
-        self.OOstatstics /= float(self.nwaters) / cell_length**3
-        self.OOstatstics /= np.shape(O_traj)[-1]
+        self.OOstatstics /= float(self.nwaters) / np.prod(np.broadcast_to(cell_length, 3))
+        self.OOstatstics /= nframes_used
+
+    def calc_rdf(self, bin_start=0.0, bin_end=9.0, bin_num=1000, cell_length=None, start=0, stop=None, step=1):
+        """Radial distribution functions of water O-O, O-H and H-H.
+
+        All the frames start:stop:step are binned (by default, every frame)
+        with pair_distance_counts, which finds the pairs closer than bin_end
+        with periodic KD-trees and so scales to any box size. g(r) is
+        normalized by the ideal gas count in the exact volume of each shell.
+        Sets self.rdf_r (bin centers) and self.rdf[pair] for pair in OO, OH,
+        HH.
+        """
+        print("Calculating radial distribution functions of water")
+        box = np.broadcast_to(self.metadata.box if cell_length is None else np.asarray(cell_length, dtype=float), 3)
+        r_edges = np.linspace(bin_start, bin_end, bin_num + 1)
+        counts = {"OO": 0, "OH": 0, "HH": 0}
+        nframes_used = 0
+        for block in self.traj_blocks(atoms=self.topology.water_atoms, start=start, stop=stop, step=step):
+            O_traj = block[:, 0::3]
+            H_traj = np.concatenate([block[:, 1::3], block[:, 2::3]], axis=1)
+            counts["OO"] += pair_distance_counts(O_traj, O_traj, r_edges, box)
+            counts["OH"] += pair_distance_counts(O_traj, H_traj, r_edges, box)
+            counts["HH"] += pair_distance_counts(H_traj, H_traj, r_edges, box)
+            nframes_used += block.shape[0]
+        shell_volume = 4.0 / 3.0 * np.pi * (r_edges[1:]**3 - r_edges[:-1]**3)
+        natoms = {"O": self.nwaters, "H": 2*self.nwaters}
+        self.rdf_r = 0.5 * (r_edges[1:] + r_edges[:-1])
+        self.rdf = {}
+        for pair in counts:
+            density = natoms[pair[1]] / np.prod(box)
+            self.rdf[pair] = counts[pair] / (natoms[pair[0]] * density * shell_volume * nframes_used)
 
     def auto_correlation_function_fft(self, x):
         corr = signal.fftconvolve(x, x[::-1], mode='same')
@@ -256,23 +1756,60 @@ class MD_Analysis:
     def auto_correlation_function_simple(self, x):
         n = x.size
         if n % 2 == 0:
-            x_shifted = np.zeros(n*2)
+            x_shifted = np.zeros(n*2, dtype=x.dtype)
         else:
-            x_shifted = np.zeros(n*2-1)
+            x_shifted = np.zeros(n*2-1, dtype=x.dtype)
         x_shifted[n//2 : n//2+n] = x
         # Convolute the shifted array with the flipped array, which is equivalent to performing a correlation
-        autocorr_full = (signal.fftconvolve(x_shifted, x[::-1], mode='same')[-n:]/ np.arange(n, 0, -1))
+        autocorr_full = (signal.fftconvolve(x_shifted, x[::-1], mode='same')[-n:]/ np.arange(n, 0, -1, dtype=x.dtype))
         # Truncate the autocorrelation array
         autocorr = autocorr_full[0:n//2]
         return autocorr
 
+    def auto_correlation_function_batch(self, x, max_rows=256):
+        # The autocorrelation functions of all the rows of x (..., nframes) at
+        # once, the same as auto_correlation_function_simple of each row: the
+        # average of x[t] x[t+k] over the n-k pairs of lag k, for k < n//2.
+        # Zero padding to a fast FFT length of at least 2n-1 avoids wrapping
+        # around, and scipy.fft reuses its plan for every chunk of max_rows rows.
+        # The FFTs and the result are in double precision whatever the dtype of
+        # x: in single precision, the correlation of a large mean dipole loses
+        # the fluctuations the spectra are made of.
+        n = x.shape[-1]
+        nfft = scipy.fft.next_fast_len(2*n - 1, real=True)
+        rows = x.reshape(-1, n)
+        acf = np.empty((rows.shape[0], n//2), dtype=np.result_type(x.dtype, np.float64))
+        for i in range(0, rows.shape[0], max_rows):
+            sp = scipy.fft.rfft(rows[i:i+max_rows].astype(acf.dtype, copy=False), nfft, axis=-1, workers=self.nprocs)
+            acf[i:i+max_rows] = scipy.fft.irfft(sp.real**2 + sp.imag**2, nfft, axis=-1, workers=self.nprocs)[:, :n//2]
+        acf /= np.arange(n, n - n//2, -1, dtype=acf.dtype)
+        return acf.reshape(x.shape[:-1] + (n//2,))
+
+    def mean_square_displacement_batch(self, x, max_rows=256):
+        # The mean square displacements of all the rows of x (..., nframes), the
+        # average of (x[t+k] - x[t])^2 over the n-k time origins of lag k, for
+        # k < n//2. With the sums of squares S(k) over the origins, which are
+        # differences of cumulative sums, msd(k) = S(k) / (n-k) - 2 acf(k), with
+        # the acf from auto_correlation_function_batch: O(n log n) per row
+        # instead of a loop over the time origins.
+        n = x.shape[-1]
+        rows = x.reshape(-1, n)
+        msd = self.auto_correlation_function_batch(rows, max_rows=max_rows)
+        msd *= -2.0
+        lags = np.arange(n//2)
+        for i in range(0, rows.shape[0], max_rows):
+            squares = np.zeros((rows[i:i+max_rows].shape[0], n + 1), dtype=msd.dtype)
+            np.cumsum(rows[i:i+max_rows].astype(msd.dtype, copy=False)**2, axis=-1, out=squares[:, 1:])
+            msd[i:i+max_rows] += (squares[:, n - lags] + squares[:, n:] - squares[:, lags]) / (n - lags)
+        return msd.reshape(x.shape[:-1] + (n//2,))
+
     def fft(self, x):
         #sp = np.fft.fft(x)
         #freq_au = 2.0 * np.pi * np.fft.fftfreq(np.size(x), self.dtau)
         # Because dt has the unit of fs, I need to transform fs^{-1} to cm^{-1}
         #freq_cminverse = freq_au * 219474.63
         #return freq_cminverse[0:sp.size//2], sp[0:sp.size//2]
-        lineshape = fftpack.dct(x, type=1)
+        lineshape = fftpack.dct(np.asarray(x, dtype=np.float64), type=1)
         freq_au = np.linspace(0, 0.5/self.dtfs * 1e15, len(x))
         # Because dt has the unit of fs, I need to transform fs^{-1} to cm^{-1}
         freq_cminverse = freq_au / (100.0 * 299792458.0)
@@ -280,7 +1817,7 @@ class MD_Analysis:
 
     def fft3(self, x ):
         # Adding zeros to the end of x
-        lineshape = fftpack.dct(x, type=1)
+        lineshape = fftpack.dct(np.asarray(x, dtype=np.float64), type=1)
         freq_au = np.linspace(0, 0.5/self.dtfs * 1e15, len(x))
         # Because dt has the unit of fs, I need to transform fs^{-1} to cm^{-1}
         freq_cminverse = freq_au / (100.0 * 299792458.0)
@@ -291,9 +1828,99 @@ class MD_Analysis:
         return freq_cminverse, spectra
         #return freq_cminverse[0:spectra.size//2], spectra[0:spectra.size//2]
 
+    # The method writing the output file simu_*.xc.xyz.<name>.txt of each
+    # observable
+    # The stride of the frames an output reads if it is not 1, which leaves
+    # fewer frames in the blocks of a stream (estimate_task_memory)
+    frame_strides = {"pair_dist": 10}
+
+    output_methods = {"vac": "output_velocity_autocorrelation",
+                      "msd": "output_mean_square_displacement",
+                      "Ovac": "output_Ovelocity_autocorrelation",
+                      "Hvac": "output_Hvelocity_autocorrelation",
+                      "OHvac": "output_OHvelocity_autocorrelation",
+                      "dac": "output_dipole_autocorrelation",
+                      "dac_molecules": "output_molecular_dipole_spectra",
+                      "dac_welch": "output_dipole_spectrum_welch",
+                      "photon_acf": "output_photon_autocorrelation",
+                      "photon_energy": "output_photon_energy",
+                      "oac1": "output_orientation_autocorrelation",
+                      "oac2": "output_orientation_autocorrelation2",
+                      "bond_length_dist": "output_bond_length",
+                      "pair_dist": "output_pair_dist",
+                      "rdf": "output_rdf"}
+
+    # The version of the code of each output, 1 if not given here; increase it
+    # when a change alters the numbers of an output, so that the results
+    # cached by ResultManifest are computed again. 2: correlation functions
+    # and spectra computed in float64 also for a float32 trajectory
+    output_versions = {"vac": 2, "msd": 2, "Ovac": 2, "Hvac": 2, "OHvac": 2, "dac": 2, "dac_molecules": 2,
+                       "dac_welch": 2, "photon_acf": 2, "oac1": 2, "oac2": 2}
+
+    def output_observables(self, names, nworkers=1):
+        # Write the outputs of several observables from one load of the
+        # trajectory; the intermediates they share are only computed once.
+        # With nworkers > 1, the groups of observables of observable_groups
+        # run at the same time in nworkers processes, which attach to the
+        # trajectory in shared memory instead of each holding a copy.
+        for name in names:
+            if name not in self.output_methods:
+                raise ValueError("Unknown observable %s, choose from %s" %(name, ", ".join(self.output_methods)))
+        self.require_traj()
+        groups = observable_groups(names)
+        if nworkers <= 1 or len(groups) <= 1:
+            for name in names:
+                getattr(self, self.output_methods[name])()
+            self.derived_data.clear()
+            return
+        nworkers = min(nworkers, len(groups))
+        budget = self.derived_data.budget
+        options = {"dtfs": self.dtfs, "nframe_max": self.nframe_max, "block_size": self.block_size,
+                   "nprocs": max(1, self.nprocs // nworkers), "dtype": self.dtype,
+                   "memory_budget": budget / nworkers if budget is not None else None}
+        # The outputs which only need blocks of frames read the "frame" layout
+        layouts = [layout for layout, used in [("time", any(name in self.memory_use for name in names)),
+                                               ("frame", any(name not in self.memory_use for name in names))] if used]
+        shared = self.share_arrays(layouts)
+        print("Writing %d groups of outputs with %d processes" %(len(groups), nworkers))
+        try:
+            # The workers are forked and would print what is left in the buffer again
+            sys.stdout.flush()
+            with ProcessPoolExecutor(nworkers) as executor:
+                futures = [executor.submit(run_shared_observables, (self.xyz_filename, group, options, shared))
+                           for group in groups]
+                for future in futures:
+                    future.result()
+        finally:
+            for shm in self.shared_blocks:
+                shm.unlink()
+            self.release_arrays()
+
+    def accumulate_folder_observable(self, observable, compute=True, **params):
+        # The accumulators of a folder observable (FOLDER_OBSERVABLES) for
+        # this trajectory, also saved as run_filename.<observable>.<name>.npz
+        # so that any job can combine the trajectories of a folder; they are
+        # loaded from there if up to date, and else computed unless compute
+        # is False, which returns None
+        make, method = FOLDER_OBSERVABLES[observable][:2]
+        accumulators = make(**params)
+        filenames = dict((name, "%s.%s.%s.npz" %(self.run_filename, observable, name)) for name in accumulators)
+        key = self.results.key(observable, **params)
+        if all(self.results.is_current(filename, key) for filename in filenames.values()):
+            print("Have accumulated %s for %s, loading..." %(observable, self.xyz_filename))
+            return dict((name, type(accumulator).load(filenames[name])) for name, accumulator in accumulators.items())
+        if not compute:
+            return None
+        getattr(self, method)(accumulators)
+        for name, accumulator in accumulators.items():
+            accumulator.save(filenames[name])
+            self.results.record(filenames[name], key)
+        return accumulators
+
     def output_velocity_autocorrelation(self):
-        local_filename = "%s.vac.txt" %self.xyz_filename
-        if os.path.isfile(local_filename + "dd"):
+        local_filename = "%s.vac.txt" %self.run_filename
+        key = self.results.key("vac")
+        if self.results.is_current(local_filename, key):
             print("Have calculated COM diffusion for %s, skipping..." %self.xyz_filename)
         else:
             self.cacl_center_of_mass_water_traj()
@@ -311,10 +1938,76 @@ class MD_Analysis:
             data[:, 9] = smooth(self.vacf_tot_sp)
             comments = "# vacf_time_fs, vacf_x, vacf_y, vacf_z, vacf_tot, freq, sp_x, sp_y, sp_z, sp_tot"
             np.savetxt(local_filename, data, comments=comments)
+            self.results.record(local_filename, key)
+
+    def output_mean_square_displacement(self):
+        local_filename = "%s.msd.txt" %self.run_filename
+        key = self.results.key("msd")
+        if self.results.is_current(local_filename, key):
+            print("Have calculated mean square displacement for %s, skipping..." %self.xyz_filename)
+        else:
+            self.cacl_msd_water_traj()
+            # output data
+            data = np.zeros((np.size(self.msd_time_fs), 5))
+            data[:, 0] = self.msd_time_fs
+            data[:, 1] = self.msd_x
+            data[:, 2] = self.msd_y
+            data[:, 3] = self.msd_z
+            data[:, 4] = self.msd_tot
+            comments = "# msd_time_fs, msd_x, msd_y, msd_z, msd_tot"
+            np.savetxt(local_filename, data, comments=comments)
+            self.results.record(local_filename, key)
+
+    def output_Ovelocity_autocorrelation(self):
+        local_filename = "%s.Ovac.txt" %self.run_filename
+        key = self.results.key("Ovac")
+        if self.results.is_current(local_filename, key):
+            print("Have calculated Oxygen diffusion for %s, skipping..." %self.xyz_filename)
+        else:
+            self.cacl_Ovelocity_water_traj()
+            # output data
+            data = np.zeros((np.size(self.vacf_time_fs_O), 10))
+            data[:, 0] = self.vacf_time_fs_O
+            data[:, 1] = self.vacf_Ox
+            data[:, 2] = self.vacf_Oy
+            data[:, 3] = self.vacf_Oz
+            data[:, 4] = self.vacf_Otot
+            data[:, 5] = self.vacf_Ox_freq
+            data[:, 6] = smooth(self.vacf_Ox_sp)
+            data[:, 7] = smooth(self.vacf_Oy_sp)
+            data[:, 8] = smooth(self.vacf_Oz_sp)
+            data[:, 9] = smooth(self.vacf_Otot_sp)
+            comments = "# vacf_time_fs, vacf_x, vacf_y, vacf_z, vacf_tot, freq, sp_x, sp_y, sp_z, sp_tot"
+            np.savetxt(local_filename, data, comments=comments)
+            self.results.record(local_filename, key)
+
+    def output_Hvelocity_autocorrelation(self):
+        local_filename = "%s.Hvac.txt" %self.run_filename
+        key = self.results.key("Hvac")
+        if self.results.is_current(local_filename, key):
+            print("Have calculated Hydrogen diffusion for %s, skipping..." %self.xyz_filename)
+        else:
+            self.cacl_Hvelocity_water_traj()
+            # output data
+            data = np.zeros((np.size(self.vacf_time_fs_H), 10))
+            data[:, 0] = self.vacf_time_fs_H
+            data[:, 1] = self.vacf_Hx
+            data[:, 2] = self.vacf_Hy
+            data[:, 3] = self.vacf_Hz
+            data[:, 4] = self.vacf_Htot
+            data[:, 5] = self.vacf_Hx_freq
+            data[:, 6] = smooth(self.vacf_Hx_sp)
+            data[:, 7] = smooth(self.vacf_Hy_sp)
+            data[:, 8] = smooth(self.vacf_Hz_sp)
+            data[:, 9] = smooth(self.vacf_Htot_sp)
+            comments = "# vacf_time_fs, vacf_x, vacf_y, vacf_z, vacf_tot, freq, sp_x, sp_y, sp_z, sp_tot"
+            np.savetxt(local_filename, data, comments=comments)
+            self.results.record(local_filename, key)
 
     def output_OHvelocity_autocorrelation(self):
-        local_filename = "%s.OHvac.txt" %self.xyz_filename
-        if os.path.isfile(local_filename):
+        local_filename = "%s.OHvac.txt" %self.run_filename
+        key = self.results.key("OHvac")
+        if self.results.is_current(local_filename, key):
             print("Have calculated OH bond diffusion for %s, skipping..." %self.xyz_filename)
         else:
             self.cacl_OHvelocity_water_traj()
@@ -332,13 +2025,15 @@ class MD_Analysis:
             data[:, 9] = smooth(self.vacf_OHtot_sp)
             comments = "# vacf_time_fs, vacf_x, vacf_y, vacf_z, vacf_tot, freq, sp_x, sp_y, sp_z, sp_tot"
             np.savetxt(local_filename, data, comments=comments)
+            self.results.record(local_filename, key)
 
     def output_dipole_autocorrelation(self, which_molecule=None):
         if which_molecule is None:
-            local_filename = "%s.dac.txt" %self.xyz_filename
+            local_filename = "%s.dac.txt" %self.run_filename
         else:
-            local_filename = "%s.dac_%d.txt" %(self.xyz_filename, which_molecule)
-        if os.path.isfile(local_filename + "dd"):
+            local_filename = "%s.dac_%d.txt" %(self.run_filename, which_molecule)
+        key = self.results.key("dac", which_molecule=which_molecule)
+        if self.results.is_current(local_filename, key):
             print("Have calculated dipole autocorrelation for %s, skipping..." %self.xyz_filename)
         else:
             self.cacl_dipole_water_traj(which_molecule=which_molecule)
@@ -356,10 +2051,85 @@ class MD_Analysis:
             data[:, 9] = smooth(self.dacf_tot_sp)
             comments = "# dacf_time_fs, dacf_x, dacf_y, dacf_z, dacf_tot, freq, sp_x, sp_y, sp_z, sp_tot"
             np.savetxt(local_filename, data, comments=comments)
+            self.results.record(local_filename, key)
+
+    def output_dipole_spectrum_welch(self, nperseg=2048, noverlap=None, nfft=None, window="hann"):
+        # The columns freq, sp_x, sp_y, sp_z, sp_tot of the dac output
+        local_filename = "%s.dac_welch.txt" %self.run_filename
+        key = self.results.key("dac_welch", nperseg=nperseg, noverlap=noverlap, nfft=nfft, window=window)
+        if self.results.is_current(local_filename, key):
+            print("Have calculated dipole spectrum for %s, skipping..." %self.xyz_filename)
+        else:
+            self.cacl_dipole_spectrum_welch(nperseg=nperseg, noverlap=noverlap, nfft=nfft, window=window)
+            # output data
+            data = np.zeros((np.size(self.dsp_freq), 5))
+            data[:, 0] = self.dsp_freq
+            data[:, 1] = self.dsp_x
+            data[:, 2] = self.dsp_y
+            data[:, 3] = self.dsp_z
+            data[:, 4] = self.dsp_tot
+            comments = "# freq, sp_x, sp_y, sp_z, sp_tot"
+            np.savetxt(local_filename, data, comments=comments)
+            self.results.record(local_filename, key)
+
+    def output_photon_autocorrelation(self):
+        local_filename = "%s.photon_acf.txt" %self.run_filename
+        key = self.results.key("photon_acf")
+        if self.topology.nphotons == 0:
+            print("No photons in %s, skipping..." %self.xyz_filename)
+        elif self.results.is_current(local_filename, key):
+            print("Have calculated photon autocorrelation for %s, skipping..." %self.xyz_filename)
+        else:
+            self.cacl_photon_autocorrelation()
+            # output data: time, the acf of each photon, freq, the spectrum of each photon
+            nphotons = self.topology.nphotons
+            data = np.zeros((np.size(self.pacf_time_fs), 2 + 2*nphotons))
+            data[:, 0] = self.pacf_time_fs
+            data[:, 1:1+nphotons] = self.pacf.T
+            data[:, 1+nphotons] = self.pacf_freq
+            for i in range(nphotons):
+                data[:, 2+nphotons+i] = smooth(self.pacf_sp[i])
+            comments = "# pacf_time_fs, pacf of %d photons, freq, sp of %d photons" %(nphotons, nphotons)
+            np.savetxt(local_filename, data, comments=comments)
+            self.results.record(local_filename, key)
+
+    def output_photon_energy(self):
+        local_filename = "%s.photon_energy.txt" %self.run_filename
+        key = self.results.key("photon_energy")
+        if self.topology.nphotons == 0:
+            print("No photons in %s, skipping..." %self.xyz_filename)
+        elif self.results.is_current(local_filename, key):
+            print("Have calculated photon energy for %s, skipping..." %self.xyz_filename)
+        else:
+            self.cacl_photon_energy()
+            # output data: time, the energy of each photon and the total
+            nphotons = self.topology.nphotons
+            data = np.zeros((np.size(self.photon_energy_time_fs), 2 + nphotons))
+            data[:, 0] = self.photon_energy_time_fs
+            data[:, 1:1+nphotons] = self.photon_energy.T
+            data[:, 1+nphotons] = np.sum(self.photon_energy, axis=0)
+            comments = "# time_fs, energy (Hartree) of %d photons, total" %nphotons
+            np.savetxt(local_filename, data, comments=comments)
+            self.results.record(local_filename, key)
+
+    def output_molecular_dipole_spectra(self):
+        # One npz file instead of a dac_<i>.txt per molecule: time_fs and freq,
+        # and the (nmolecules, nfreq) arrays dacf_tot and sp_tot (not smoothed)
+        local_filename = "%s.dac_molecules.npz" %self.run_filename
+        key = self.results.key("dac_molecules")
+        if self.results.is_current(local_filename, key):
+            print("Have calculated dipole spectra of all molecules for %s, skipping..." %self.xyz_filename)
+        else:
+            self.cacl_molecular_dipole_spectra()
+            print("output data as %s" %local_filename)
+            np.savez(local_filename, time_fs=self.dacf_molecules_time_fs, freq=self.dacf_molecules_freq,
+                     dacf_tot=self.dacf_molecules, sp_tot=self.dacf_molecules_sp)
+            self.results.record(local_filename, key)
 
     def output_orientation_autocorrelation(self):
-        local_filename = "%s.oac1.txt" %self.xyz_filename
-        if os.path.isfile(local_filename + "dd"):
+        local_filename = "%s.oac1.txt" %self.run_filename
+        key = self.results.key("oac1")
+        if self.results.is_current(local_filename, key):
             print("Have calculated 1st orientation autocorrelation for %s, skipping..." %self.xyz_filename)
         else:
             self.cacl_orientation_water_traj()
@@ -377,51 +2147,614 @@ class MD_Analysis:
             data[:, 9] = smooth(self.oacfz_tot_sp)
             comments = "# oacfz_time_fs, oacfz_x, oacfz_y, oacfz_z, oacfz_tot, freq, sp_x, sp_y, sp_z, sp_tot"
             np.savetxt(local_filename, data, comments=comments)
+            self.results.record(local_filename, key)
+
+    def output_orientation_autocorrelation2(self):
+        local_filename = "%s.oac2.txt" %self.run_filename
+        key = self.results.key("oac2")
+        if self.results.is_current(local_filename, key):
+            print("Have calculated 2nd orientation autocorrelation for %s, skipping..." %self.xyz_filename)
+        else:
+            self.cacl_orientation_water_traj2()
+            # output data
+            data = np.zeros((np.size(self.oacfz2_time_fs), 4))
+            data[:, 0] = self.oacfz2_time_fs
+            data[:, 1] = self.oacfz2_tot
+            data[:, 2] = self.oacfz2_tot_freq
+            data[:, 3] = smooth(self.oacfz2_tot_sp)
+            comments = "# oacfz2_time_fs, oacfz2_tot, freq,  sp_tot"
+            np.savetxt(local_filename, data, comments=comments)
+            self.results.record(local_filename, key)
 
     def output_bond_length(self, bin_start=0.5, bin_end=1.5, bin_num=1000):
-        local_filename = "%s.bond_length_dist.txt" %self.xyz_filename
-        if os.path.isfile(local_filename + "dd"):
+        local_filename = "%s.bond_length_dist.txt" %self.run_filename
+        key = self.results.key("bond_length_dist", bin_start=bin_start, bin_end=bin_end, bin_num=bin_num)
+        if self.results.is_current(local_filename, key):
             print("Have calculated bond length distribution for %s, skipping..." %self.xyz_filename)
         else:
             self.calc_bond_length_dist(bin_start=bin_start, bin_end=bin_end, bin_num=bin_num)
             # output data
             data = np.zeros((np.size(self.bond_bins)-1, 2))
             data[:, 0] = self.bond_bins[:-1]
-            data[:, 1] = self.bond_statistics.astype(np.float)
+            data[:, 1] = self.bond_statistics.astype(float)
             comments = "# bins, counts"
             np.savetxt(local_filename, data, comments=comments)
+            self.results.record(local_filename, key)
 
-    def output_pair_dist(self, bin_start=0.1, bin_end=9, bin_num=1000, cell_length=18.6445):
-        local_filename = "%s.pair_dist.txt" %self.xyz_filename
-        if os.path.isfile(local_filename + "dd"):
+    def output_pair_dist(self, bin_start=0.1, bin_end=9, bin_num=1000, cell_length=None):
+        local_filename = "%s.pair_dist.txt" %self.run_filename
+        key = self.results.key("pair_dist", bin_start=bin_start, bin_end=bin_end, bin_num=bin_num, cell_length=cell_length)
+        if self.results.is_current(local_filename, key):
             print("Have calculated pair distribution function for %s, skipping..." %self.xyz_filename)
         else:
             self.calc_pair_dist_OO(bin_start=bin_start, bin_end=bin_end, bin_num=bin_num, cell_length=cell_length)
             # output data
             data = np.zeros((np.size(self.r_bins)-1, 2))
             data[:, 0] = self.r_bins[1:]
-            data[:, 1] = self.OOstatstics.astype(np.float)
+            data[:, 1] = self.OOstatstics.astype(float)
             comments = "# bins, OO"
             print("output data as %s" %local_filename)
             np.savetxt(local_filename, data, comments=comments)
+            self.results.record(local_filename, key)
+
+
+    def output_rdf(self, bin_start=0.0, bin_end=9.0, bin_num=1000, cell_length=None):
+        local_filename = "%s.rdf.txt" %self.run_filename
+        key = self.results.key("rdf", bin_start=bin_start, bin_end=bin_end, bin_num=bin_num, cell_length=cell_length)
+        if self.results.is_current(local_filename, key):
+            print("Have calculated radial distribution functions for %s, skipping..." %self.xyz_filename)
+        else:
+            self.calc_rdf(bin_start=bin_start, bin_end=bin_end, bin_num=bin_num, cell_length=cell_length)
+            # output data
+            data = np.zeros((np.size(self.rdf_r), 4))
+            data[:, 0] = self.rdf_r
+            data[:, 1] = self.rdf["OO"]
+            data[:, 2] = self.rdf["OH"]
+            data[:, 3] = self.rdf["HH"]
+            comments = "# r, g_OO, g_OH, g_HH"
+            print("output data as %s" %local_filename)
+            np.savetxt(local_filename, data, comments=comments)
+            self.results.record(local_filename, key)
+
+
+# The outputs written for each trajectory by this script
+DEFAULT_OBSERVABLES = ["bond_length_dist", "pair_dist", "vac", "msd", "dac", "oac1", "OHvac"]
+
+# Observables accumulated over all the trajectories of a folder rather than
+# written per trajectory: the function making the empty accumulators, the
+# MD_Analysis method filling them and the function writing the folder output
+FOLDER_OBSERVABLES = {"water_geometry": (water_geometry_histograms, "accumulate_geometry", output_geometry_histograms)}
+
+
+def derived_closure(names):
+    # The derived arrays names and all the derived arrays they are computed from
+    closure = set()
+    while names:
+        name = names.pop()
+        if name not in closure:
+            closure.add(name)
+            names = names + MD_Analysis.derived_arrays[name][1]
+    return closure
+
+
+def observable_groups(names):
+    # Split the outputs names into groups which share no derived array but the
+    # trajectory itself, so that they can run in different processes without
+    # computing an intermediate twice, e.g., vac and msd (com_traj) or oac1
+    # and oac2 (orientation_acf); the slowest groups (MD_Analysis.output_runtimes)
+    # come first, so that they are not left to run alone at the end
+    groups = []
+    for name in names:
+        uses = derived_closure(list(MD_Analysis.memory_use.get(name, ([], 0.0))[0])) - {"traj_time", "traj_frame"}
+        related = [group for group in groups if group[1] & uses]
+        for group in related:
+            groups.remove(group)
+        groups.append((sum([group[0] for group in related], []) + [name],
+                       uses.union(*[group[1] for group in related])))
+    weight = lambda group: -sum(MD_Analysis.output_runtimes.get(name, 0.01) for name in group[0])
+    return [group[0] for group in sorted(groups, key=weight)]
+
+
+def run_shared_observables(task):
+    # Worker of MD_Analysis.output_observables: write the outputs names of a
+    # trajectory from the arrays the parent process shared (share_arrays)
+    xyz_filename, names, options, shared = task
+    analysis = MD_Analysis(xyz_filename, **dict(options, stream=True))
+    analysis.attach_arrays(shared)
+    try:
+        for name in names:
+            getattr(analysis, analysis.output_methods[name])()
+    finally:
+        analysis.release_arrays()
+    return names
+
+
+def estimate_task_memory(xyz_filename, observables, nframe_max=10001, stream=False, block_size=1000, dtype=np.float64,
+                         memory_budget=None, observable_workers=1, read_size=1<<24, **options):
+    """Estimate the peak memory in bytes of the outputs observables of a trajectory.
+
+    Takes the MD_Analysis keyword arguments. The number of frames is the
+    (decompressed) file size over the size of the first frame, at most
+    nframe_max, or nframe_max for a compressed file not indexed yet. Reading
+    holds a block of frames as lines and their parsed arrays (a stride of
+    MD_Analysis.frame_strides leaves fewer frames in a block) and, for a
+    compressed file, a chunk of read_size bytes split into lines (see
+    iter_xyz_blocks). Unless stream is set, the trajectory is loaded; then
+    come the derived arrays the observables use (at most memory_budget bytes
+    of them, but the arrays of one output at least) and the largest
+    temporary arrays of one output, both from MD_Analysis.memory_use. With
+    observable_workers > 1 (see run_trajectory_tasks), the trajectory is
+    shared with the layouts its outputs read and the temporary arrays of as
+    many outputs are held at once.
+    """
+    with open_xyz(xyz_filename) as myfile:
+        natoms = int(myfile.readline().strip())
+        frame_bytes = len(str(natoms)) + 1 + sum(len(line) for line in islice(myfile, natoms + 1))
+    size = xyz_file_size(xyz_filename, scan=False)
+    nframes = nframe_max if size is None else min(nframe_max, max(1, size // frame_bytes))
+    traj_bytes = natoms * 3 * nframes * np.dtype(dtype).itemsize
+    # Measured on streamed runs: a line of a block takes about 250 bytes
+    # besides its text (line object, object array and np.loadtxt), and a
+    # chunk is held up to three times while the next one is read and split
+    # into lines of about 50 bytes overhead
+    line_bytes = frame_bytes / (natoms + 2)
+    strides = [MD_Analysis.frame_strides.get(observable, 1) for observable in observables] if stream else [1]
+    nblock = min(block_size, max(-(-nframes // stride) for stride in strides))
+    peak = nblock * ((natoms + 2) * (line_bytes + 250) + 2 * natoms * 3 * np.dtype(dtype).itemsize)
+    if is_compressed(xyz_filename):
+        peak += 3 * read_size + read_size / line_bytes * (line_bytes + 50)
+    if stream:
+        return peak
+    uses = [MD_Analysis.memory_use.get(observable, (["traj_frame"], 0.0)) for observable in observables]
+    derived_size = lambda names: sum(MD_Analysis.derived_sizes[name] for name in derived_closure(list(names))) * traj_bytes
+    derived_bytes = derived_size([name for names, temporary in uses for name in names])
+    if memory_budget is not None:
+        derived_bytes = max(min(derived_bytes, memory_budget), max(derived_size(names) for names, temporary in uses))
+    temporaries = sorted([temporary for names, temporary in uses], reverse=True)[:max(1, observable_workers)]
+    if observable_workers > 1:
+        layouts = [name for names, temporary in uses for name in names if name == "traj_frame"]
+        layouts += ["traj_time"] if len(layouts) < len(uses) else []
+        derived_bytes = max(derived_bytes, derived_size(layouts))
+    return peak + traj_bytes + derived_bytes + sum(temporaries) * traj_bytes
+
+
+def run_trajectory_tasks(tasks, options, accept=None, observable_workers=1):
+    """Run the (xyz_filename, observable, params) tasks of one trajectory.
+
+    Worker of run_batch. The trajectory, with the MD_Analysis keyword
+    arguments options, is only loaded by the first task whose output is not
+    up to date (see ResultManifest) and needs it, and then kept for the
+    other tasks; the tasks which need the whole trajectory run first so that
+    the others read it from memory too. A task which raises does not stop
+    the others. With the acceptance rules accept of an analysis plan, a
+    trajectory whose size was not known when it was accepted (see
+    accepted_trajectories) is checked first, and its tasks are "rejected" if
+    it fails. With observable_workers > 1, and unless options stream the
+    trajectory, the outputs without parameters are written last and together
+    by MD_Analysis.output_observables in observable_workers processes, and
+    each reports the time they took together. Returns (xyz_filename,
+    observable, status, seconds, result) for every task, with status "done"
+    or "failed" and result the accumulators of a folder observable or the
+    traceback of a failure.
+    """
+    if accept is not None and tasks:
+        try:
+            size = xyz_file_size(tasks[0][0])
+        except (IOError, OSError, ValueError):
+            # The tasks will report what is wrong with the file
+            size = None
+        if size is not None and not size_accepted(size, accept):
+            return [(xyz_filename, observable, "rejected", 0.0, "%d bytes, rejected by the size rules" %size)
+                    for xyz_filename, observable, params in tasks]
+    results = []
+    analysis = None
+    fanned = []
+    if observable_workers > 1 and not options.get("stream"):
+        fanned = [task for task in tasks if task[1] in MD_Analysis.output_methods and not task[2]]
+        tasks = [task for task in tasks if task not in fanned]
+    tasks = sorted(tasks, key=lambda task: not MD_Analysis.memory_use.get(task[1], ([], 0.0))[0])
+    for xyz_filename, observable, params in tasks:
+        t0 = time.time()
+        try:
+            if analysis is None:
+                analysis = MD_Analysis(xyz_filename, **dict(options, stream=True))
+            if observable in FOLDER_OBSERVABLES:
+                result = analysis.accumulate_folder_observable(observable, **params)
+            else:
+                getattr(analysis, analysis.output_methods[observable])(**params)
+                result = None
+            results.append((xyz_filename, observable, "done", time.time() - t0, result))
+        except Exception:
+            results.append((xyz_filename, observable, "failed", time.time() - t0, traceback.format_exc()))
+    if fanned:
+        # Last, so that the trajectory loaded by the tasks above is shared
+        t0 = time.time()
+        try:
+            if analysis is None:
+                analysis = MD_Analysis(fanned[0][0], **dict(options, stream=True))
+            analysis.output_observables([task[1] for task in fanned], observable_workers)
+            status, result = "done", None
+        except Exception:
+            status, result = "failed", traceback.format_exc()
+        results += [(xyz_filename, observable, status, time.time() - t0, result) for xyz_filename, observable, params in fanned]
+    return results
+
+
+def run_batch(tasks, nworkers=1, memory_limit=None, claims=None, accept=None, observable_workers=1, **options):
+    """Run (xyz_filename, observable, params) tasks in a pool of nworkers processes.
+
+    params are the keyword arguments of the output method of the observable
+    (or of the function making the accumulators of a folder observable).
+    Consecutive tasks of the same trajectory go to the same worker, which
+    loads it once. With a memory_limit (bytes), the outputs of a trajectory
+    which only need blocks of frames are split off and streamed instead, and
+    the peak memory of each part is estimated with estimate_task_memory. The
+    largest parts which fit next to the running ones within memory_limit are
+    started first, so that small streamed parts fill the memory left by
+    large loaded ones; a part above memory_limit runs alone. A task which
+    raises is reported as failed and the others go on. If a worker process
+    dies (e.g., killed when out of memory), the parts it shared the pool
+    with are run again one at a time in a process of their own, so the
+    failure stays with its trajectory. With claims (a WorkClaims, in its
+    with block), every trajectory is claimed before its first part starts
+    and released after its last one, and the tasks of a trajectory claimed
+    by another job are "skipped", with the holder as result. accept and
+    observable_workers are passed on to run_trajectory_tasks; with
+    observable_workers > 1 the tasks of a trajectory are not split, as its
+    outputs share the loaded trajectory, and a worker may run up to
+    observable_workers processes. With nworkers = 1 the tasks run in this
+    process. The status of every task is printed as it finishes; returns the
+    results of run_trajectory_tasks.
+    """
+    for xyz_filename, observable, params in tasks:
+        if observable not in MD_Analysis.output_methods and observable not in FOLDER_OBSERVABLES:
+            raise ValueError("Unknown observable %s, choose from %s"
+                             %(observable, ", ".join(list(MD_Analysis.output_methods) + list(FOLDER_OBSERVABLES))))
+    # Parts of (tasks, MD_Analysis options, estimated memory)
+    parts = []
+    for xyz_filename, group in groupby(tasks, key=lambda task: task[0]):
+        group = list(group)
+        if memory_limit is None:
+            parts.append((group, options, 0))
+            continue
+        if observable_workers > 1 and not options.get("stream"):
+            streamed = []
+        else:
+            streamed = [task for task in group if not MD_Analysis.memory_use.get(task[1], ([], 0.0))[0]]
+        loaded = [task for task in group if task not in streamed]
+        for part, part_options in [(loaded, options), (streamed, dict(options, stream=True))]:
+            if part:
+                try:
+                    memory = estimate_task_memory(xyz_filename, [task[1] for task in part], observable_workers=observable_workers,
+                                                  **part_options)
+                except (IOError, OSError, ValueError):
+                    # The tasks will report what is wrong with the file
+                    memory = 0
+                parts.append((part, part_options, memory))
+    results = []
+    # The parts left of each trajectory, whose claim is released after the last
+    remaining = {}
+    for part in parts:
+        remaining[part[0][0][0]] = remaining.get(part[0][0][0], 0) + 1
+
+    def report(group_results):
+        for xyz_filename, observable, status, seconds, result in group_results:
+            results.append((xyz_filename, observable, status, seconds, result))
+            print("[%d/%d] %s %s: %s in %.1f s" %(len(results), len(tasks), xyz_filename, observable, status, seconds))
+            if status in ["failed", "skipped", "rejected"]:
+                print("    %s" %result.rstrip().splitlines()[-1])
+
+    def start(part):
+        # Whether this job may run a part, claiming its trajectory if needed
+        xyz_filename = part[0][0][0]
+        if claims is None or xyz_filename in claims.held:
+            return True
+        holder = claims.claim(xyz_filename)
+        if holder is None:
+            return True
+        report([(xyz_filename, observable, "skipped", 0.0, "claimed by %s" %holder) for xyz_filename, observable, params in part[0]])
+        finish(part)
+        return False
+
+    def finish(part):
+        xyz_filename = part[0][0][0]
+        remaining[xyz_filename] -= 1
+        if remaining[xyz_filename] == 0 and claims is not None and xyz_filename in claims.held:
+            claims.release(xyz_filename)
+
+    if nworkers <= 1:
+        for part in parts:
+            if start(part):
+                report(run_trajectory_tasks(part[0], part[1], accept, observable_workers))
+                finish(part)
+        return results
+    pending = sorted(parts, key=lambda part: -part[2])
+    while pending:
+        lost = []
+        # The workers are forked and would print what is left in the buffer again
+        sys.stdout.flush()
+        with ProcessPoolExecutor(nworkers) as executor:
+            running, in_use = {}, 0
+            while (pending and not lost) or running:
+                for part in list(pending):
+                    if lost or len(running) >= nworkers:
+                        break
+                    if memory_limit is None or not running or in_use + part[2] <= memory_limit:
+                        pending.remove(part)
+                        if not start(part):
+                            continue
+                        if memory_limit is not None and part[2] > memory_limit:
+                            print("%s needs about %.1f GB, more than the memory limit, running it alone" %(part[0][0][0], part[2] / 1e9))
+                        running[executor.submit(run_trajectory_tasks, part[0], part[1], accept, observable_workers)] = part
+                        in_use += part[2]
+                for future in wait(running, return_when=FIRST_COMPLETED)[0]:
+                    part = running.pop(future)
+                    in_use -= part[2]
+                    try:
+                        report(future.result())
+                        finish(part)
+                    except BrokenProcessPool:
+                        lost.append(part)
+        for group, part_options, memory in lost:
+            print("Running %s again in a process of its own" %group[0][0])
+            sys.stdout.flush()
+            with ProcessPoolExecutor(1) as executor:
+                try:
+                    report(executor.submit(run_trajectory_tasks, group, part_options, accept, observable_workers).result())
+                except BrokenProcessPool:
+                    report([(xyz_filename, observable, "failed", 0.0, "The worker process died")
+                            for xyz_filename, observable, params in group])
+            finish((group, part_options, memory))
+    return results
+
+
+def default_analysis_plan(folders):
+    """The analysis plan of the folders given on the command line.
+
+    An analysis plan is a dict, read from a JSON file by
+    read_analysis_plan, with the entries
+      "folders": the folders (or glob patterns of folders) to analyze;
+      "accept": the rules a trajectory of these folders must pass, with
+          "patterns" the glob patterns of the file names (compressed
+          copies are included) and "min_size", "max_size" and "size" the
+          bounds or the exact value of the (decompressed) file size in
+          bytes, null for no rule;
+      "observables": the names of the outputs (DEFAULT_OBSERVABLES,
+          MD_Analysis.output_methods or FOLDER_OBSERVABLES), or objects
+          {"observable": name, parameter: value, ...} to pass parameters
+          to its output method;
+      "options": MD_Analysis keyword arguments (nframe_max, dtfs, stream,
+          block_size, "dtype": "float32" or "float64", "memory_budget" in
+          GB);
+      "workers" and "max_memory" (in GB): the nworkers and memory_limit of
+          run_batch;
+      "observable_workers": the processes among which the outputs of one
+          trajectory are spread, see run_trajectory_tasks;
+      "claim_expiry": null, or the expiry in seconds of the WorkClaims
+          with which several jobs share the plan, each analyzing the
+          trajectories no other job has claimed.
+    Missing entries take the values of this default plan, which analyzes
+    the trajectories of a complete 20 ps run.
+    """
+    return {"folders": list(folders),
+            "accept": {"patterns": ["simu_*.xc.xyz"], "min_size": 313681365, "max_size": None, "size": None},
+            "observables": DEFAULT_OBSERVABLES + list(FOLDER_OBSERVABLES),
+            "options": {}, "workers": 1, "max_memory": None, "observable_workers": 1, "claim_expiry": None}
+
+
+PLAN_OPTIONS = ["nframe_max", "dtfs", "stream", "block_size", "dtype", "memory_budget"]
+
+
+def check_analysis_plan(plan, overrides={}, options={}):
+    """Fill in and check an analysis plan before anything runs.
+
+    overrides replace entries of the plan and options entries of its
+    "options". Every observable becomes an (observable, params) pair. An
+    unknown entry, observable, parameter or option raises ValueError.
+    """
+    default = default_analysis_plan([])
+    plan = dict(plan, **overrides)
+    for name in plan:
+        if name not in default:
+            raise ValueError("Unknown entry %s of the analysis plan, choose from %s" %(name, ", ".join(default)))
+    accept = dict(default["accept"])
+    accept.update(plan.get("accept", {}))
+    for name in accept:
+        if name not in default["accept"]:
+            raise ValueError("Unknown acceptance rule %s, choose from %s" %(name, ", ".join(default["accept"])))
+    if isinstance(accept["patterns"], str):
+        accept["patterns"] = [accept["patterns"]]
+    observables = []
+    for entry in plan.get("observables", default["observables"]):
+        params = {"observable": entry} if isinstance(entry, str) else dict(entry)
+        observable = params.pop("observable", None)
+        if observable in FOLDER_OBSERVABLES:
+            function = FOLDER_OBSERVABLES[observable][0]
+            if observable in [name for name, other in observables]:
+                raise ValueError("The folder observable %s is given twice" %observable)
+        elif observable in MD_Analysis.output_methods:
+            function = getattr(MD_Analysis, MD_Analysis.output_methods[observable])
+            params["self"] = None
+        else:
+            raise ValueError("Unknown observable %s, choose from %s"
+                             %(observable, ", ".join(list(MD_Analysis.output_methods) + list(FOLDER_OBSERVABLES))))
+        try:
+            inspect.signature(function).bind(**params)
+        except TypeError as error:
+            raise ValueError("Wrong parameters for %s: %s" %(observable, error))
+        params.pop("self", None)
+        observables.append((observable, params))
+    plan_options = dict(plan.get("options", {}), **options)
+    for name in plan_options:
+        if name not in PLAN_OPTIONS:
+            raise ValueError("Unknown option %s, choose from %s" %(name, ", ".join(PLAN_OPTIONS)))
+    if plan_options.get("dtype", "float64") not in ["float32", "float64"]:
+        raise ValueError("dtype must be float32 or float64, not %s" %plan_options["dtype"])
+    return {"folders": list(plan.get("folders", [])), "accept": accept, "observables": observables,
+            "options": plan_options, "workers": max(1, int(plan.get("workers", 1))), "max_memory": plan.get("max_memory"),
+            "observable_workers": max(1, int(plan.get("observable_workers", 1))), "claim_expiry": plan.get("claim_expiry")}
+
+
+def read_analysis_plan(plan_filename, overrides={}, options={}):
+    # Relative folders are taken from the folder of the plan file; see
+    # default_analysis_plan for the content and check_analysis_plan for
+    # overrides and options
+    with open(plan_filename) as myfile:
+        plan = json.load(myfile)
+    if not isinstance(plan, dict):
+        raise ValueError("The analysis plan %s is not a JSON object" %plan_filename)
+    base = os.path.dirname(plan_filename)
+    plan["folders"] = [os.path.normpath(os.path.join(base, folder)) for folder in plan.get("folders", [])]
+    return check_analysis_plan(plan, overrides, options)
+
+
+def size_accepted(size, accept):
+    # Whether a (decompressed) trajectory size passes the rules of a plan
+    if accept["min_size"] is not None and size < accept["min_size"]:
+        return False
+    if accept["max_size"] is not None and size > accept["max_size"]:
+        return False
+    return accept["size"] is None or size == accept["size"]
+
+
+def accepted_trajectories(folder, accept):
+    """The trajectories of a folder which pass the acceptance rules of a plan.
+
+    A run is only taken once: of a trajectory and its compressed copies,
+    e.g., while xz -k is running, the uncompressed file is taken, or else
+    the first of COMPRESSED_XYZ_CODECS. The size of a compressed trajectory
+    is only known once its frame index is built, which decodes the whole
+    file, so one without an index is accepted here and checked by the
+    worker analyzing it (see run_trajectory_tasks).
+    """
+    runs = {}
+    for pattern in accept["patterns"]:
+        for suffix in [""] + list(COMPRESSED_XYZ_CODECS):
+            for filename in glob.glob(os.path.join(folder, pattern + suffix)):
+                run = filename[:len(filename) - len(suffix)] if suffix else filename
+                runs.setdefault(run, set()).add(suffix)
+    accepted = []
+    for run in sorted(runs):
+        suffix = [suffix for suffix in [""] + list(COMPRESSED_XYZ_CODECS) if suffix in runs[run]][0]
+        if len(runs[run]) > 1:
+            print("Taking %s%s of the copies %s" %(run, suffix, ", ".join(run + other for other in sorted(runs[run]))))
+        size = xyz_file_size(run + suffix, scan=False)
+        if size is None or size_accepted(size, accept):
+            accepted.append(run + suffix)
+    return accepted
+
+
+def run_analysis_plan(plan):
+    """Run an analysis plan checked by check_analysis_plan.
+
+    Every observable of the plan is computed for every accepted trajectory
+    of its folders with run_batch, the cores of this job being shared by
+    the workers (and the processes of each, with observable_workers); the
+    folder observables are then combined over the trajectories of each
+    folder and written as folder/<name>. With a
+    claim_expiry, the trajectories claimed by other jobs are skipped and
+    their folder observables are read from the files they leave (see
+    MD_Analysis.accumulate_folder_observable); a folder is only written by
+    the job which finds all of them done. Returns the results of run_batch.
+    """
+    folders = []
+    for folder in plan["folders"]:
+        folders += sorted(glob.glob(folder)) if glob.has_magic(folder) else [folder]
+    tasks, trajectory_folders = [], {}
+    for folder in folders:
+        for filename in accepted_trajectories(folder, plan["accept"]):
+            if filename not in trajectory_folders:
+                trajectory_folders[filename] = folder
+                tasks += [(filename, observable, params) for observable, params in plan["observables"]]
+    print("Analysis plan: %d trajectories in %d folders, %d tasks" %(len(trajectory_folders), len(folders), len(tasks)))
+    # All the cores this job may use, shared by the workers
+    nprocs = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else multiprocessing.cpu_count()
+    options = dict(plan["options"], nprocs=max(1, nprocs // plan["workers"]))
+    options["dtype"] = np.dtype(options.get("dtype", "float64"))
+    if options.get("memory_budget") is not None:
+        options["memory_budget"] = options["memory_budget"] * 1e9
+    memory_limit = plan["max_memory"] * 1e9 if plan["max_memory"] is not None else None
+    if plan["claim_expiry"] is None:
+        results = run_batch(tasks, plan["workers"], memory_limit, None, plan["accept"], plan["observable_workers"], **options)
+    else:
+        with WorkClaims(plan["claim_expiry"]) as claims:
+            print("Claiming trajectories as %s" %claims.owner)
+            results = run_batch(tasks, plan["workers"], memory_limit, claims, plan["accept"], plan["observable_workers"], **options)
+    # Combine the folder observables of the trajectories of each folder
+    for name, params in plan["observables"]:
+        if name not in FOLDER_OBSERVABLES:
+            continue
+        make, method, output = FOLDER_OBSERVABLES[name]
+        for folder in folders:
+            parts = [result for xyz_filename, observable, status, seconds, result in results
+                     if observable == name and status == "done" and trajectory_folders[xyz_filename] == folder]
+            skipped = [xyz_filename for xyz_filename, observable, status, seconds, result in results
+                       if observable == name and status == "skipped" and trajectory_folders[xyz_filename] == folder]
+            missing = False
+            for xyz_filename in skipped:
+                try:
+                    part = MD_Analysis(xyz_filename, **dict(options, stream=True)).accumulate_folder_observable(name, False, **params)
+                except (IOError, OSError, ValueError):
+                    part = None
+                if part is None:
+                    print("%s of %s is not done yet, left to the job which finishes it" %(name, xyz_filename))
+                    missing = True
+                    break
+                parts.append(part)
+            if parts and not missing:
+                combined = make(**params)
+                for part in parts:
+                    for key in combined:
+                        combined[key] += part[key]
+                output(os.path.join(folder, name), combined)
+    return results
 
 
 if __name__ == "__main__":
-    default_file_size=313681365
-    paths = sys.argv[1:]
-    for i, path in enumerate(paths):
-        filenames = glob.glob("%s/simu_*.xc.xyz" %path)
-        for filename in filenames:
-            if os.path.getsize(filename) >= default_file_size:
-                a = MD_Analysis(xyz_filename=filename)
-                a.output_bond_length()
-                a = MD_Analysis(xyz_filename=filename)
-                a.output_pair_dist()
-                a = MD_Analysis(xyz_filename=filename)
-                a.output_velocity_autocorrelation()
-                a = MD_Analysis(xyz_filename=filename)
-                a.output_dipole_autocorrelation(which_molecule=None)
-                a = MD_Analysis(xyz_filename=filename)
-                a.output_orientation_autocorrelation()
-                a = MD_Analysis(xyz_filename=filename)
-                a.output_OHvelocity_autocorrelation()
+    # --plan=file.json: the analysis plan to run, see read_analysis_plan;
+    # otherwise the folders on the command line are analyzed with the
+    # default plan. The options below override the ones of the plan.
+    # --float32: single precision storage of the trajectory, see
+    # "python benchmark_collect_all_data.py precision" for the accuracy check
+    # --dtfs=FS: time between frames, needed if there is no i-PI input
+    # --memory-budget=GB: memory kept for arrays shared between observables
+    # --workers=N: trajectories analyzed at the same time
+    # --observable-workers=N: processes writing the outputs of one trajectory
+    # --max-memory=GB: memory the workers may use together, see run_batch
+    # --claim[=SECONDS]: share the folders with other jobs, see WorkClaims
+    plan_filename, overrides, options, paths = None, {}, {}, []
+    for arg in sys.argv[1:]:
+        if arg.startswith("--plan="):
+            plan_filename = arg.split("=", 1)[1]
+        elif arg == "--float32":
+            options["dtype"] = "float32"
+        elif arg.startswith("--dtfs="):
+            options["dtfs"] = float(arg.split("=", 1)[1])
+        elif arg.startswith("--memory-budget="):
+            options["memory_budget"] = float(arg.split("=", 1)[1])
+        elif arg.startswith("--workers="):
+            overrides["workers"] = int(arg.split("=", 1)[1])
+        elif arg.startswith("--observable-workers="):
+            overrides["observable_workers"] = int(arg.split("=", 1)[1])
+        elif arg.startswith("--max-memory="):
+            overrides["max_memory"] = float(arg.split("=", 1)[1])
+        elif arg == "--claim":
+            overrides["claim_expiry"] = 600.0
+        elif arg.startswith("--claim="):
+            overrides["claim_expiry"] = float(arg.split("=", 1)[1])
+        else:
+            paths.append(arg)
+    if plan_filename is not None:
+        if paths:
+            print("The folders are given by the plan %s, not on the command line" %plan_filename)
+            sys.exit(1)
+        plan = read_analysis_plan(plan_filename, overrides, options)
+    else:
+        plan = check_analysis_plan(default_analysis_plan(paths), overrides, options)
+    results = run_analysis_plan(plan)
+    failed = [(xyz_filename, observable, result) for xyz_filename, observable, status, seconds, result in results if status == "failed"]
+    if failed:
+        print("%d of %d tasks failed:" %(len(failed), len(results)))
+        for xyz_filename, observable, result in failed:
+            print("%s %s\n%s" %(xyz_filename, observable, result))
+        sys.exit(1)